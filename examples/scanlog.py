@@ -9,6 +9,12 @@ import re
 import sys
 from enum import IntEnum, auto
 
+# kvetch.py is in the parent directory when installed and in src in the
+# repository. When run by kvetch, this imports the running kvetch.
+sys.path.extend([os.path.join(os.path.dirname(os.path.abspath(__file__)),d)
+                 for d in ('..', os.path.join('..','src'))])
+from kvetch import PatternSet, Scanner, iter_line_blocks
+
 class State(IntEnum):
     Prologue = auto()
     CheckOut = auto()
@@ -17,96 +23,103 @@ class State(IntEnum):
     Epilogue = auto()
     Summary = auto()
     
-state = State.Prologue
-log = {}
-
-def add_logging(line):
-    global log,state
-    if (log.get(state) is None):
-        log[state]=""
-    log[state]+=line+"\n"
-
-# Define actions for each pattern
-def handle_begin_checkout(line,timestamp,match):
-    global state
-    state = State.CheckOut
-
-def handle_begin_build(line,timestamp,match):
-    global state
-    state = State.Build
-
-def handle_begin_test(line,timestamp,match):
-    global state
-    state = State.Test
-
-def handle_begin_epilogue(line,timestamp,match):
-    global state
-    state = State.Epilogue
-
-def handle_generic_error(line,timestamp,match):
-    add_logging(f"[ERROR] {line}")
-
-def ignore_pattern(line,timestamp,match):
-    None
-
+#
+# A new ScanLog is made by kvetch for each build log and fed the log in
+# blocks of whole lines. Each section keeps a list of the lines logged
+# while the build was in that state.
+#
+class ScanLog(Scanner):
+    def __init__(self):
+        self.state = State.Prologue
+        self.log = {}
+        self.count = 0
+        self.partial = False
+
+    def add_logging(self, line):
+        self.log.setdefault(self.state, []).append(line)
+
+    # Define actions for each pattern
+    def handle_begin_checkout(self,line,timestamp,match):
+        self.state = State.CheckOut
+
+    def handle_begin_build(self,line,timestamp,match):
+        self.state = State.Build
+
+    def handle_begin_test(self,line,timestamp,match):
+        self.state = State.Test
+
+    def handle_begin_epilogue(self,line,timestamp,match):
+        self.state = State.Epilogue
+
+    def handle_generic_error(self,line,timestamp,match):
+        self.add_logging(f"[ERROR] {line}")
+
+    def ignore_pattern(self,line,timestamp,match):
+        None
+
+    def feed(self, text):
+        self.count+=text.count('\n')
+        self.partial = not text.endswith('\n')
+        for lmatch, message, action, match in pattern_set.scan(text):
+            timestamp = lmatch.group(1)
+            action(self,message,timestamp,match)
+
+    def finish(self):
+        summary={}
+        sections=[]
+        for s in State:
+            if (s == State.Summary):
+                continue
+            if (self.log.get(s) is not None):
+                sections.append(f"{s.name}\n")
+                sections.append('-'*len(s.name) + "\n")
+                sections.extend(line + "\n" for line in self.log[s])
+                sections.append("\n")
+        # Only the failures found identify a failure
+        summary['signature']=''.join(sections)
+        if (not sections):
+            sections.append("No known failures were detected\n")
+
+        summary['count']=self.count + self.partial
+        summary['summary']=''.join(sections)
+        return summary
+
+# Checked in order, the first pattern found in a line handles it
 pattern_actions = {
     # Patterns for state transition
-    re.compile(r"^git clone"): handle_begin_checkout,
-    re.compile(r"make -f all.mk all"): handle_begin_build,
-    re.compile(r"^Testing initiated"): handle_begin_test,
-    re.compile(r"^Testing complete"): handle_begin_epilogue,
+    re.compile(r"^git clone"): ScanLog.handle_begin_checkout,
+    re.compile(r"make -f all.mk all"): ScanLog.handle_begin_build,
+    re.compile(r"^Testing initiated"): ScanLog.handle_begin_test,
+    re.compile(r"^Testing complete"): ScanLog.handle_begin_epilogue,
 
     # Patterns that look like failures, but are not
-    re.compile(r"^ERROR: Skipping something permanently disabled"): ignore_pattern,
+    re.compile(r"^ERROR: Skipping something permanently disabled"): ScanLog.ignore_pattern,
 
     # Patterns to things that looks like failures
-    re.compile(r": \*\*\*"): handle_generic_error,
-    re.compile(r"^ERROR:"): handle_generic_error,
-    re.compile(r"^ssh: (.*)"): handle_generic_error,
-    re.compile(r"^rsync: (.*)"): handle_generic_error,
-    re.compile(r"^rsync error: (.*)"): handle_generic_error,
-    re.compile(r"^FATAL: (.*)"): handle_generic_error,
-    re.compile(r"^fatal: (.*)"): handle_generic_error,
-    re.compile(r"^Caused: (.*)"): handle_generic_error,
-    re.compile(r":\d+:\d+: error: "): handle_generic_error,
+    re.compile(r": \*\*\*"): ScanLog.handle_generic_error,
+    re.compile(r"^ERROR:"): ScanLog.handle_generic_error,
+    re.compile(r"^ssh: (.*)"): ScanLog.handle_generic_error,
+    re.compile(r"^rsync: (.*)"): ScanLog.handle_generic_error,
+    re.compile(r"^rsync error: (.*)"): ScanLog.handle_generic_error,
+    re.compile(r"^FATAL: (.*)"): ScanLog.handle_generic_error,
+    re.compile(r"^fatal: (.*)"): ScanLog.handle_generic_error,
+    re.compile(r"^Caused: (.*)"): ScanLog.handle_generic_error,
+    re.compile(r":\d+:\d+: error: "): ScanLog.handle_generic_error,
 }
 
+# Skip off timestamp for easier reading
+lpattern = r"(\[\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z\])?\s*"
 
+pattern_set = PatternSet(pattern_actions.items(), lpattern)
+
+#
+# Scans a whole log file, for configurations that still name scan_log
+#
 def scan_log(f):
-    global state,log
-    state = State.Prologue    
-    log={}
-    summary={}
-    count=0
-    # Skip off timestamp for easier reading
-    lpattern = r"^(\[\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z\])?\s*(.*)"
-    for line in f:
-        count+=1
-        lmatch = re.match(lpattern, line)
-        timestamp = lmatch.group(1)
-        message = lmatch.group(2)
-        for pattern, action in pattern_actions.items():
-            match = pattern.search(message)
-            if match:
-                action(message,timestamp,match)
-                break
-
-    state = State.Summary
-    no_logging = True
-    for s in State:
-        if (s == State.Summary):
-            continue
-        if (log.get(s) is not None):
-            add_logging(f"{s.name}")
-            add_logging('-'*len(s.name))
-            add_logging(log[s])
-            no_logging = False
-    if (no_logging):
-        add_logging("No known failures were detected")
-
-    summary['count']=count
-    summary['summary']=log[State.Summary]
-    return summary
+    scanner = ScanLog()
+    for text in iter_line_blocks(f):
+        scanner.feed(text)
+    return scanner.finish()
 
 #
 # Main Program
@@ -137,5 +150,5 @@ if __name__ == "__main__":
 
     f.close()
 
-    print(summary('summary'),end='')
+    print(summary['summary'],end='')
     sys.exit(0)
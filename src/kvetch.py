@@ -4,21 +4,49 @@
 #
 # Licensed under BSD 3-Clause License
 
+import asyncio
+import atexit
+import base64
+import codecs
+import collections
+import contextlib
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import datetime
 from email.message import EmailMessage
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import importlib
 import io
 import jenkins
 import json
+import multiprocessing
 import os
 from pathlib import Path
+import queue
+import random
 import re
+import requests
+import signal
 import smtplib
 import sqlite3
 import sys
+import tempfile
 import textwrap
+import threading
+import time
+from urllib.parse import parse_qs, quote, urlparse
 import zlib
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 #
 # Jenkins
 #
@@ -28,6 +56,7 @@ import zlib
 #
 jenkins_url=None
 jenkins_auth=None
+server=None
 def connect_jenkins():
     global server, jenkins_url
 
@@ -37,14 +66,348 @@ def connect_jenkins():
         jenkins_api_token = file.read()
 
     try:
-        server = jenkins.Jenkins(jenkins_url,
+        server = KvetchJenkins(jenkins_url,
                                         username=jenkins_username,
-                                        password=jenkins_api_token)
+                                        password=jenkins_api_token,
+                                        timeout=jenkins_timeout)
     except jenkins.JenkinsException as e:
        raise Exception(f"Error connecting to Jenkins: {e}")
+    if (jenkins_backend == 'aiohttp'):
+        start_jenkins_loop()
+
+#
+# Requests to Jenkins go through a token bucket refilled at jenkins_rate
+# requests per second. A request that times out, cannot connect or gets
+# 429, 502, 503 or 504 back is retried up to jenkins_retries times, after
+# a random delay of up to jenkins_retry_delay seconds, doubled for each
+# retry, or after the Retry-After Jenkins asks for. When the requests
+# slow down past jenkins_slow_seconds the rate is halved, and it climbs
+# back while they are fast. After jenkins_breaker_failures failures in a
+# row the circuit opens: no request is sent for jenkins_breaker_seconds,
+# then one failure more opens it again.
+#
+jenkins_timeout=60
+jenkins_rate=20
+jenkins_burst=10
+jenkins_retries=4
+jenkins_retry_delay=1
+jenkins_slow_seconds=5
+jenkins_breaker_failures=5
+jenkins_breaker_seconds=30
+JENKINS_RETRY_STATUS = (429, 502, 503, 504)
+JENKINS_RETRY_DELAY_MAX = 60
+JENKINS_RATE_MIN = 1
+
+class KvetchJenkins(jenkins.Jenkins):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.username = kwargs.get('username')
+        self.password = kwargs.get('password')
+        self._throttle_lock = threading.Lock()
+        self._rate = jenkins_rate
+        self._tokens = jenkins_burst
+        self._refilled = time.monotonic()
+        self._rate_changed = 0
+        self._latency = 0
+        self._failures = 0
+        self._open_until = 0
+
+    def _request(self, req, stream=None):
+        retry = req.method in ('GET', 'HEAD')
+        delay = jenkins_retry_delay
+        for attempt in range(jenkins_retries + 1):
+            while (wait := self.throttle_wait()):
+                time.sleep(wait)
+            start = time.monotonic()
+            try:
+                response = super()._request(req, stream)
+            except (requests.ConnectionError, requests.Timeout):
+                self.request_failed()
+                if (not retry or attempt == jenkins_retries):
+                    raise
+                wait = None
+            else:
+                if (response.status_code not in JENKINS_RETRY_STATUS):
+                    self.request_succeeded(time.monotonic() - start)
+                    return response
+                self.request_failed()
+                if (not retry or attempt == jenkins_retries):
+                    return response
+                wait = retry_after(response.headers)
+                response.close()
+            time.sleep(wait if wait is not None else random.uniform(0, delay))
+            delay = min(2*delay, JENKINS_RETRY_DELAY_MAX)
+
+    # Takes a token, or returns the seconds to wait before asking again
+    def throttle_wait(self):
+        with self._throttle_lock:
+            now = time.monotonic()
+            if (now < self._open_until):
+                return self._open_until - now
+            if (not jenkins_rate):
+                return 0
+            self._tokens = min(jenkins_burst, self._tokens +
+                               (now - self._refilled)*self._rate)
+            self._refilled = now
+            if (self._tokens >= 1):
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens)/self._rate
+
+    def request_succeeded(self, latency):
+        with self._throttle_lock:
+            self._failures = 0
+            self._latency = 0.8*self._latency + 0.2*latency
+            if (self._latency > jenkins_slow_seconds):
+                self._slow_down()
+            elif (jenkins_rate):
+                self._rate = min(jenkins_rate, self._rate + 0.1)
+
+    def request_failed(self):
+        with self._throttle_lock:
+            self._failures += 1
+            self._slow_down()
+            if (self._failures >= jenkins_breaker_failures):
+                self._open_until = time.monotonic() + jenkins_breaker_seconds
+                self._failures = jenkins_breaker_failures - 1
+
+    # At most once a second, as the requests in flight all see it
+    def _slow_down(self):
+        now = time.monotonic()
+        if (jenkins_rate and now - self._rate_changed >= 1):
+            self._rate = max(self._rate/2, JENKINS_RATE_MIN)
+            self._rate_changed = now
+
+def retry_after(headers):
+    wait = headers.get('Retry-After', '')
+    return min(int(wait), JENKINS_RETRY_DELAY_MAX) if wait.isdigit() else None
+
+#
+# Fetch engine
+#
+# Build JSON and console logs are fetched by a bounded pool of worker
+# threads, with at most fetch_host_limit requests in flight per Jenkins
+# host. Results are handed back in submission order to the main thread,
+# which stays the only thread that prints or touches SQLite.
+#
+fetch_workers=8
+fetch_host_limit=4
+fetch_pool=None
+host_slots={}
+host_slots_lock=threading.Lock()
+
+def get_fetch_pool():
+    global fetch_pool
+    if (fetch_pool is None):
+        if (jenkins_loop):
+            fetch_pool = AsyncFetchPool()
+        else:
+            fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers,
+                                            thread_name_prefix="kvetch-fetch")
+    return fetch_pool
+
+def close_fetch_pool():
+    global fetch_pool
+    if (fetch_pool):
+        fetch_pool.shutdown(cancel_futures=True)
+        fetch_pool = None
+
+def host_slot(url=None):
+    host = urlparse(url or jenkins_url).netloc
+    with host_slots_lock:
+        slot = host_slots.get(host)
+        if (slot is None):
+            slot = threading.BoundedSemaphore(fetch_host_limit)
+            host_slots[host] = slot
+    return slot
+
+def map_ordered(pool, window, func, items, key=None, args=()):
+    """
+    Yields (item, func(*args, item)) for each item, in order, keeping up
+    to window calls running ahead of the consumer on pool. With key, func
+    is called with key(item) instead, and items whose key is None are
+    yielded with None. Calls that have not started are cancelled if the
+    consumer stops early.
+    """
+    pending = collections.deque()
+    try:
+        for item in items:
+            arg = key(item) if key else item
+            pending.append((item, None if arg is None
+                                  else pool.submit(func,*args,arg)))
+            if (len(pending) >= window):
+                item, future = pending.popleft()
+                yield (item, future and future.result())
+        while (pending):
+            item, future = pending.popleft()
+            yield (item, future and future.result())
+    finally:
+        for item, future in pending:
+            if (future):
+                future.cancel()
+
+def fetch_ordered(func, items, *args):
+    """
+    Yields func(*args, item) for each item, in order, keeping up to twice
+    fetch_workers calls (jenkins_async_limit with the aiohttp backend)
+    running ahead of the consumer.
+    """
+    window = jenkins_async_limit if jenkins_loop else 2*fetch_workers
+    results = map_ordered(get_fetch_pool(), window, func, items, args=args)
+    for item, result in results:
+        yield result
+
+#
+# Projections
+#
+# Only the fields kvetch uses are requested, through the Jenkins tree=
+# query parameter, instead of the full job and build JSON.
+#
+JOB_POINTERS = [ 'lastBuild', 'lastCompletedBuild',
+                 'lastFailedBuild', 'lastSuccessfulBuild' ]
+CHANGE_TREE = 'items[authorEmail,comment,affectedPaths,commitId]'
+CLAIM_TREE = 'actions[_class,claimedBy,assignedBy,claimDate,reason]'
+BUILD_TREE = ('number,inProgress,fullDisplayName,description,result,'
+              'duration,timestamp,url,'
+              f'changeSets[{CHANGE_TREE}],changeSet[{CHANGE_TREE}],'
+              f'{CLAIM_TREE}')
+# The claim of lastFailedBuild comes along so syncing can keep it current
+# without fetching the build again.
+JOB_TREE = ('name,fullName,url,allBuilds[number],' +
+            ','.join(p+'[number]' for p in JOB_POINTERS
+                     if p != 'lastFailedBuild') +
+            f',lastFailedBuild[number,{CLAIM_TREE}]')
+
+def job_path(job_name):
+    return ''.join('job/%s/' % quote(p) for p in job_name.split('/'))
+
+def view_path(view):
+    return 'view/%s/' % quote(view)
+
+#
+# HTTP cache
+#
+# The JSON Jenkins returns is cached in its own SQLite file next to the
+# DB, so runs started shortly after each other, and the fetch threads of
+# a run, share it. Each kind of request is cached for its own time in
+# http_cache_ttls, a build still running for the 'running' time. Expired
+# responses that came with an ETag or Last-Modified are revalidated with
+# a conditional request instead of being fetched again. A finished build
+# is cached no longer than a job: its claims and description can still be
+# edited, and Jenkins sends no ETag for api/json to revalidate with.
+#
+http_cache = True
+http_cache_ttls = {
+    'view': 10,
+    'job': 10,
+    'build': 10,
+    'running': 0,
+}
+http_cache_conn = None
+http_cache_lock = threading.Lock()
+
+def init_http_cache():
+    global http_cache_conn
+    if (not http_cache or db_path == ":memory:"):
+        return
+    http_cache_conn = sqlite3.connect(db_path + '-httpcache',
+                                      isolation_level=None,
+                                      check_same_thread=False)
+    http_cache_conn.execute('PRAGMA journal_mode=WAL')
+    http_cache_conn.execute('PRAGMA synchronous=NORMAL')
+    http_cache_conn.execute('''
+        CREATE TABLE IF NOT EXISTS responses (
+            url             TEXT PRIMARY KEY,
+            expires         REAL,
+            etag            TEXT,
+            lastModified    TEXT,
+            body            BLOB
+        )
+    ''')
+    # Expired for a day, they are not worth revalidating
+    http_cache_conn.execute('''
+        DELETE FROM responses WHERE expires < ?
+    ''', (time.time() - 24*60*60,))
+
+def close_http_cache():
+    global http_cache_conn
+    if (http_cache_conn):
+        http_cache_conn.close()
+        http_cache_conn = None
+
+def http_cache_get(url):
+    with http_cache_lock:
+        return http_cache_conn.execute('''
+            SELECT expires, etag, lastModified, body
+            FROM responses WHERE url = ?
+        ''', (url,)).fetchone()
+
+def http_cache_put(url, ttl, etag, last_modified, body):
+    with http_cache_lock:
+        http_cache_conn.execute('''
+            INSERT OR REPLACE INTO responses
+            (url, expires, etag, lastModified, body)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (url, time.time() + ttl, etag, last_modified,
+              zlib.compress(body, 1)))
+
+#
+# Returns (data, cached, headers): the data of a fresh cached response, or
+# None with the cached row and the headers to revalidate it with
+#
+def http_cache_lookup(url, kind):
+    cached = None
+    if (kind and http_cache_conn):
+        cached = http_cache_get(url)
+
+    headers = {}
+    if (cached):
+        expires, etag, last_modified, body = cached
+        if (expires > time.time()):
+            return (json.loads(zlib.decompress(body)), cached, headers)
+        if (etag):
+            headers['If-None-Match'] = etag
+        if (last_modified):
+            headers['If-Modified-Since'] = last_modified
+    return (None, cached, headers)
+
+def http_cache_store(url, kind, cached, status, headers, body):
+    if (cached and status == 304):
+        body = zlib.decompress(cached[3])
+    data = json.loads(body)
+
+    if (kind and http_cache_conn):
+        if (kind == 'build' and data.get('inProgress')):
+            kind = 'running'
+        http_cache_put(url, http_cache_ttls[kind],
+                       headers.get('ETag', cached and cached[1]),
+                       headers.get('Last-Modified', cached and cached[2]),
+                       body)
+    return data
+
+def jenkins_json_url(path, tree):
+    return server.server + path + 'api/json?tree=' + quote(tree, safe=',[]{}')
+
+#
+# kind is the http_cache_ttls entry the response is cached for, or None
+# to always ask Jenkins
+#
+def jenkins_get_json(path, tree, kind=None):
+    if (jenkins_loop):
+        return run_async(async_jenkins_get_json(path, tree, kind))
+    url = jenkins_json_url(path, tree)
+    data, cached, headers = http_cache_lookup(url, kind)
+    if (data is not None):
+        return data
+
+    with host_slot():
+        response = server.jenkins_request(
+            requests.Request('GET', url, headers=headers))
+    return http_cache_store(url, kind, cached, response.status_code,
+                            response.headers, response.content)
 
 def get_job_num(real_job_info,field):
-    if (real_job_info[field]):
+    if (real_job_info.get(field)):
         return real_job_info[field].get('number')
     else:
         return None
@@ -59,39 +422,51 @@ def extract_job_component(url):
         return match.group(1)
     return None
 
-def get_jobs(view):
-    jobs=[]
-    view_jobs = server.get_jobs(view_name=view)
+def get_view_job_name(job):
+    if (job.get('fullName')):
+        return job['fullName']
 
-    for job in view_jobs:
-        job_name = job['name']
+    # Older Jenkins versions do not export fullName for view items, so
+    # fall back to getting the folder prefix out of the URL.
+    job_name = job['name']
+    job_component = extract_job_component(job['url'])
+    if (job_component):
+        job_name=job_component+'/'+job_name
+    return job_name
 
-# TBD: there is a bug here where the name given is missing the project
-# prefix. We have implemented a workaround to get the prefix out of the URL.
-# It is not clear how robust this is
-        job_component = extract_job_component(job['url'])
-        if (job_component):
-            job_name=job_component+'/'+job_name
+#
+# The projected job JSON of every job in a view is fetched with a single
+# request and kept here so get_job_info does not ask for it again.
+#
+job_info_cache={}
+def get_jobs(view):
+    jobs=[]
+    view_info = jenkins_get_json(view_path(view), f'jobs[{JOB_TREE}]',
+                                 'view')
 
+    for job in view_info['jobs']:
+        job_name = get_view_job_name(job)
+        job_info_cache[job_name] = job
         jobs.append(job_name)
     return jobs
 
 def get_job_info(job_name):
     job_info={}
     builds=[]
-    real_job_info = server.get_job_info(job_name,
-                                        fetch_all_builds=True)
-    for build in real_job_info['builds']:
+    real_job_info = job_info_cache.get(job_name)
+    if (real_job_info is None):
+        real_job_info = jenkins_get_json(job_path(job_name), JOB_TREE,
+                                         'job')
+        job_info_cache[job_name] = real_job_info
+    for build in real_job_info.get('allBuilds') or []:
         builds.append(build['number'])
 
 #    Use for for debug information
 #    job_info['json']                = real_job_info
     job_info['name']                = job_name
     job_info['builds']              = builds
-    job_info['lastBuild']           = get_job_num(real_job_info,'lastBuild')
-    job_info['lastCompletedBuild']  = get_job_num(real_job_info,'lastCompletedBuild')
-    job_info['lastFailedBuild']     = get_job_num(real_job_info,'lastFailedBuild')
-    job_info['lastSuccessfulBuild'] = get_job_num(real_job_info,'lastSuccessfulBuild')
+    for field in JOB_POINTERS:
+        job_info[field] = get_job_num(real_job_info,field)
     return job_info
 
 def get_job_infos(jobs_names,build_ids):
@@ -134,8 +509,11 @@ def get_job_infos(jobs_names,build_ids):
     return job_infos
 
 def get_build_info(job,build):
-    real_build_info = server.get_build_info(job,build)
+    real_build_info = jenkins_get_json(job_path(job)+'%d/' % build,
+                                       BUILD_TREE, 'build')
+    return make_build_info(job,build,real_build_info)
 
+def make_build_info(job,build,real_build_info):
     build_info={}
 #    Use for for debug information
 #    build_info['json']            = real_build_info
@@ -167,51 +545,364 @@ def get_build_info(job,build):
                 change_set.append(item)
 
     build_info['changeSets'] = change_set
+    build_info['claims']     = get_claims(real_build_info['actions'])
+
+    return build_info
 
+def get_claims(actions):
     claim = next(
-        (c for c in real_build_info['actions']
+        (c for c in actions
          if c.get('_class') == 'hudson.plugins.claim.ClaimBuildAction'),
         None)
 
+    claim_infos=[]
     if (claim):
-        claim_infos=[]
         claim_info={}
         claim_info['claimedBy']       = claim['claimedBy']
         claim_info['assignedBy']      = claim['assignedBy']
         claim_info['claimDate']       = claim['claimDate']
         claim_info['reason']          = claim['reason']
         claim_infos.append(claim_info)
-        build_info['claims']=claim_infos
-    else:
-        build_info['claims']=[]
+    return claim_infos
 
-    return build_info
+#
+# Status
+#
+# The state needed by -s (the last*Build pointers plus the full projected
+# lastCompletedBuild, including its claim) is fetched with one deep tree=
+# request per view, or one request per job given with -j.
+#
+STATUS_TREE = ('name,fullName,url,' +
+               ','.join(p+'[number]' for p in JOB_POINTERS
+                        if p != 'lastCompletedBuild') +
+               f',lastCompletedBuild[{BUILD_TREE}]')
+
+def get_jobs_status(view_names, job_names):
+    job_infos=[]
+    build_infos={}
+
+    def add_job_status(job_name, real_job_info):
+        job_info={}
+        job_info['name']   = job_name
+        job_info['builds'] = []
+        for field in JOB_POINTERS:
+            job_info[field] = get_job_num(real_job_info,field)
+        real_build_info = real_job_info.get('lastCompletedBuild')
+        if (real_build_info):
+            build_infos[job_name] = make_build_info(
+                job_name,real_build_info['number'],real_build_info)
+        job_infos.append(job_info)
+
+    for job_name, real_job_info in zip(job_names, fetch_ordered(
+            get_job_status, job_names)):
+        add_job_status(job_name, real_job_info)
+
+    for view in view_names:
+        view_info = jenkins_get_json(view_path(view), f'jobs[{STATUS_TREE}]',
+                                     'view')
+        for job in view_info['jobs']:
+            add_job_status(get_view_job_name(job), job)
+
+    return job_infos, build_infos
+
+def get_job_status(job_name):
+    return jenkins_get_json(job_path(job_name), STATUS_TREE, 'job')
 
 def get_build_console(job,build):
-    return server.get_build_console_output(job,build)
+    if (jenkins_loop):
+        return run_async(async_get_build_console(job,build))
+    with host_slot():
+        return server.get_build_console_output(job,build)
 
-def for_each_build(job_infos, build_pred, callback,f):
+#
+# Console logs are streamed through the progressiveText endpoint in chunks
+# of LOG_CHUNK_SIZE bytes and spooled to a temporary file that only stays
+# in memory up to LOG_SPOOL_SIZE, so memory use does not depend on the
+# size of the log.
+#
+LOG_CHUNK_SIZE = 1024*1024
+LOG_SPOOL_SIZE = 8*1024*1024
+
+def iter_build_console(job,build):
+    start = 0
+    while True:
+        url = (server.server + job_path(job) +
+               '%d/logText/progressiveText?start=%d' % (build,start))
+        with host_slot():
+            response = server.jenkins_request(requests.Request('GET', url),
+                                              stream=True)
+            try:
+                for chunk in response.iter_content(LOG_CHUNK_SIZE):
+                    if (chunk):
+                        yield chunk
+            finally:
+                response.close()
+
+        # X-More-Data is only set while the build is still writing its log
+        if (response.headers.get('X-More-Data') != 'true'):
+            break
+        start = int(response.headers['X-Text-Size'])
+        time.sleep(1)
+
+def spool_build_console(job,build):
+    spool = tempfile.SpooledTemporaryFile(max_size=LOG_SPOOL_SIZE)
+    for chunk in iter_build_console(job,build):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+#
+# Async backend
+#
+# With jenkins_backend "aiohttp" in kvetch.json (needs `pip install
+# aiohttp`), Jenkins is asked over one aiohttp session, which keeps its
+# connections alive, from an event loop run by a background thread. The
+# fetch pool then runs the coroutine twin of each fetch function on the
+# loop instead of a call on a fetch thread, so up to jenkins_async_limit
+# requests are in flight without a thread each. Requests still go through
+# the token bucket and circuit breaker of the server, and are retried the
+# same way. The HTTP cache and the log spool files are reached through
+# asyncio.to_thread(), so their disk I/O does not hold up the loop.
+#
+jenkins_backend='requests'
+jenkins_async_limit=100
+jenkins_loop=None
+jenkins_loop_thread=None
+jenkins_session=None
+jenkins_async_slot=None
+
+def start_jenkins_loop():
+    global jenkins_loop, jenkins_loop_thread
+    jenkins_loop = asyncio.new_event_loop()
+    jenkins_loop_thread = threading.Thread(target=jenkins_loop.run_forever,
+                                           name="kvetch-jenkins", daemon=True)
+    jenkins_loop_thread.start()
+    run_async(open_jenkins_session())
+    # The -s, -a and -q paths sys.exit() without finish().
+    atexit.register(close_jenkins_loop)
+
+async def open_jenkins_session():
+    global jenkins_session, jenkins_async_slot
+    jenkins_async_slot = asyncio.Semaphore(jenkins_async_limit)
+    credentials = '%s:%s' % (server.username, server.password)
+    jenkins_session = aiohttp.ClientSession(
+        headers={'Authorization': 'Basic ' +
+                 base64.b64encode(credentials.encode()).decode()},
+        timeout=aiohttp.ClientTimeout(sock_connect=jenkins_timeout,
+                                      sock_read=jenkins_timeout),
+        connector=aiohttp.TCPConnector(limit=jenkins_async_limit))
+
+def close_jenkins_loop():
+    global jenkins_loop, jenkins_loop_thread, jenkins_session
+    if (jenkins_loop):
+        atexit.unregister(close_jenkins_loop)
+        run_async(jenkins_session.close())
+        jenkins_loop.call_soon_threadsafe(jenkins_loop.stop)
+        jenkins_loop_thread.join()
+        jenkins_loop.run_until_complete(jenkins_loop.shutdown_default_executor())
+        jenkins_loop.close()
+        jenkins_loop = None
+        jenkins_loop_thread = None
+        jenkins_session = None
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, jenkins_loop).result()
+
+#
+# Returns (status, headers, body) for url, raising the JenkinsException
+# python-jenkins would. With sink, the body is written to it in chunks
+# instead. A request only counts as a success for the circuit breaker
+# once its body is read, but its latency is the time to the headers.
+#
+async def async_jenkins_request(url, headers={}, sink=None):
+    delay = jenkins_retry_delay
+    pos = sink and await asyncio.to_thread(sink.tell)
+    for attempt in range(jenkins_retries + 1):
+        while (wait := server.throttle_wait()):
+            await asyncio.sleep(wait)
+        start = time.monotonic()
+        wait = None
+        try:
+            async with jenkins_async_slot:
+                async with jenkins_session.get(url,
+                                               headers=headers) as response:
+                    latency = time.monotonic() - start
+                    if (sink and response.status < 400):
+                        async for chunk in response.content.iter_chunked(
+                                LOG_CHUNK_SIZE):
+                            await asyncio.to_thread(sink.write, chunk)
+                        body = None
+                    else:
+                        body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            server.request_failed()
+            if (attempt == jenkins_retries):
+                raise jenkins.JenkinsException(f'Error in request: {e}')
+            if (sink):
+                await asyncio.to_thread(sink.truncate, pos)
+                await asyncio.to_thread(sink.seek, pos)
+        else:
+            if (response.status not in JENKINS_RETRY_STATUS):
+                server.request_succeeded(latency)
+                break
+            server.request_failed()
+            if (attempt == jenkins_retries):
+                break
+            wait = retry_after(response.headers)
+        await asyncio.sleep(wait if wait is not None
+                            else random.uniform(0, delay))
+        delay = min(2*delay, JENKINS_RETRY_DELAY_MAX)
+
+    if (response.status == 404):
+        raise jenkins.NotFoundException('Requested item could not be found')
+    if (response.status >= 400):
+        raise jenkins.JenkinsException('Error in request [%d]: %s' %
+                                       (response.status, response.reason))
+    return (response.status, response.headers, body)
+
+async def async_jenkins_get_json(path, tree, kind=None):
+    url = jenkins_json_url(path, tree)
+    data, cached, headers = await asyncio.to_thread(http_cache_lookup,
+                                                    url, kind)
+    if (data is not None):
+        return data
+    status, headers, body = await async_jenkins_request(url, headers)
+    return await asyncio.to_thread(http_cache_store, url, kind, cached,
+                                   status, headers, body)
+
+async def async_get_build_info(job,build):
+    real_build_info = await async_jenkins_get_json(
+        job_path(job)+'%d/' % build, BUILD_TREE, 'build')
+    return make_build_info(job,build,real_build_info)
+
+async def async_get_job_status(job_name):
+    return await async_jenkins_get_json(job_path(job_name), STATUS_TREE,
+                                        'job')
+
+async def async_get_build_console(job,build):
+    status, headers, body = await async_jenkins_request(
+        server.server + job_path(job) + '%d/consoleText' % build)
+    return body.decode('utf-8', errors='replace')
+
+async def async_spool_build_console(job,build):
+    spool = tempfile.SpooledTemporaryFile(max_size=LOG_SPOOL_SIZE)
+    try:
+        return await spool_into(spool, job, build)
+    except BaseException:
+        spool.close()
+        raise
+
+async def spool_into(spool, job, build):
+    start = 0
+    while True:
+        url = (server.server + job_path(job) +
+               '%d/logText/progressiveText?start=%d' % (build,start))
+        status, headers, body = await async_jenkins_request(url, sink=spool)
+        if (headers.get('X-More-Data') != 'true'):
+            break
+        start = int(headers['X-Text-Size'])
+        await asyncio.sleep(1)
+    await asyncio.to_thread(spool.seek, 0)
+    return spool
+
+ASYNC_FETCHERS = {
+    get_build_info: async_get_build_info,
+    get_job_status: async_get_job_status,
+    spool_build_console: async_spool_build_console,
+}
+
+class AsyncFetchPool:
+    """
+    The fetch pool of the aiohttp backend. submit() runs the coroutine
+    twin of a fetch function on the Jenkins event loop and returns a
+    concurrent.futures.Future for it, like ThreadPoolExecutor.submit().
+    """
+    def __init__(self):
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        future = asyncio.run_coroutine_threadsafe(
+            ASYNC_FETCHERS[func](*args), jenkins_loop)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.discard)
+        return future
+
+    def discard(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self.lock:
+            futures = list(self.futures)
+        if (cancel_futures):
+            for future in futures:
+                future.cancel()
+        if (wait):
+            concurrent.futures.wait(futures)
+
+#
+# Build info is prefetched in parallel, but the predicate and callback are
+# always called on this thread and in build order. With fetch_log, the
+# console log of each accepted (finished) build is spooled in parallel too
+# and passed to the callback as an extra argument (a binary file).
+#
+def for_each_job_build(job_info, build_pred, callback,f,fetch_log=False):
+    ret = False # Indicates if callback called
+    job_name=job_info['name']
+    builds = job_info['builds']
+    accepted = collections.deque()
+
+    def call_next():
+        build_info,build_log = accepted.popleft()
+        if (fetch_log):
+            if (build_log):
+                build_log = build_log.result()
+            callback(f,job_info,build_info,build_log)
+        else:
+            callback(f,job_info,build_info)
+
+    try:
+        for build_info in fetch_ordered(get_build_info, builds, job_name):
+            if (build_pred):
+                pred=build_pred(job_info,build_info)
+                if (pred is None):
+                    break
+                if (pred):
+                    continue
+
+            build_log = None
+            if (fetch_log and not build_info['inProgress']):
+                build_log = get_fetch_pool().submit(
+                    spool_build_console,job_name,build_info['number'])
+            accepted.append((build_info,build_log))
+            ret=True
+            if (len(accepted) >= fetch_workers):
+                call_next()
+
+        while (accepted):
+            call_next()
+    finally:
+        # Left over when the loop failed: drop the logs being spooled
+        for build_info,build_log in accepted:
+            if (build_log and not build_log.cancel()):
+                try:
+                    build_log.result().close()
+                except Exception:
+                    pass
+    return ret
+
+def for_each_build(job_infos, build_pred, callback,f,fetch_log=False):
     ret = False # Indicates if callback called
     for job_info in job_infos:
         try:
-            job_name=job_info['name']
-            builds = job_info['builds']
-                    
-            for build in builds:
-                build_info = get_build_info(job_name,build)
-
-                if (build_pred):
-                    pred=build_pred(job_info,build_info)
-                    if (pred is None):
-                        break
-                    if (pred):
-                        continue
-                
-                callback(f,job_info,build_info)
+            if (for_each_job_build(job_info, build_pred, callback, f,
+                                   fetch_log)):
                 ret=True
 
-        except jenkins.JenkinsException as e:
-            print("%s has no jobs available" % job['name'])
+        except (jenkins.JenkinsException, requests.RequestException) as e:
+            print("%s has no jobs available" % job_info['name'])
             print(f"{e}")
     return ret
 
@@ -271,6 +962,7 @@ def get_email_of(username):
 # Sqlite
 #
 db_path = None
+db_cache_kib = 64*1024
 def init_sqlite():
     global db_path
 
@@ -284,46 +976,85 @@ def init_sqlite():
     global conn, cursor
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=%d' % -db_cache_kib)
+    db_job_ids.clear()
+    log_dict_ids.clear()
+    log_dict_attempts.clear()
 
     # During dev, we will frequently bump the version but once stable,
     # set back to the lowest unreleased numbed.
-    schema_version=1
+    schema_version=2
 
     # Only create tables if it's a new database
     if is_new_db:
         cursor.execute('CREATE TABLE schema (version INTEGER)')
         cursor.execute('INSERT INTO schema (version) VALUES (?)',
-                       (str(schema_version)))
+                       (schema_version,))
+        create_tables()
+        conn.commit()
 
-        cursor.execute('''
-            CREATE TABLE logfiles (
-                fullDisplayName TEXT PRIMARY KEY,
-                contents BLOB
-            )
-        ''')
+        print("Created Kvetch DB ver %d: %s" % (schema_version,db_path))
+    else:
+        cursor.execute('SELECT version FROM schema')
+        row=cursor.fetchone()
+        curr_version=row[0]
+        if (curr_version != schema_version):
+            if (curr_version < schema_version):
+                print("Migrating Kvetch DB schema ver %d to %d"
+                      % (curr_version, schema_version))
+                cursor.execute('BEGIN')
+                if (curr_version < 2):
+                    db_migrate_v1()
+            else:
+                print("Reseting Kvetch DB schema ver %d to %d"
+                      % (curr_version, schema_version))
+                
+            cursor.execute("UPDATE schema set version = ?",
+                           (schema_version,))
+            conn.commit()
 
-        cursor.execute('''
-            CREATE TABLE kvetch (
-                jobName         TEXT PRIMARY KEY,
-                target          TEXT,
-                build           INTEGER,
-                timestamp       INTEGER,
-                level           INTEGER
-            )
-        ''')
+    # Tables added since the current version are created when missing
+    create_tables()
+    conn.commit()
 
-        cursor.execute('''
-            CREATE TABLE builds (
-                fullDisplayName TEXT PRIMARY KEY,
-                description TEXT,
-                result TEXT not NULL,
-                duration INTEGER,
-                timestamp INTEGER,
-                url TEXT not NULL,
-                changeSets TEXT,
-                claims TEXT
-            )
-        ''')
+#
+# Builds are keyed by their job's id in jobs and their build number, so
+# the builds of a job can be range scanned. fullDisplayName is kept in
+# builds as Jenkins reported it.
+#
+def create_tables():
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id              INTEGER PRIMARY KEY,
+            name            TEXT UNIQUE NOT NULL
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS builds (
+            job_id          INTEGER NOT NULL,
+            number          INTEGER NOT NULL,
+            fullDisplayName TEXT,
+            description     TEXT,
+            result          TEXT NOT NULL,
+            duration        INTEGER,
+            timestamp       INTEGER,
+            url             TEXT NOT NULL,
+            changeSets      TEXT,
+            claims          TEXT,
+            PRIMARY KEY (job_id, number)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS builds_result
+        ON builds (job_id, result, number)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS builds_timestamp
+        ON builds (timestamp)
+    ''')
 
 #
 # JSON fields
@@ -341,44 +1072,378 @@ def init_sqlite():
 #     affectedPaths  list of TEXT,
 #
 
-        conn.commit()
+    # contents is the legacy single blob log, NULL once stored as frames
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logfiles (
+            job_id          INTEGER NOT NULL,
+            number          INTEGER NOT NULL,
+            contents        BLOB,
+            PRIMARY KEY (job_id, number)
+        )
+    ''')
 
-        print("Created Kvetch DB ver %d: %s" % (schema_version,db_path))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logchunks (
+            job_id          INTEGER NOT NULL,
+            number          INTEGER NOT NULL,
+            seq             INTEGER NOT NULL,
+            firstLine       INTEGER,
+            lineCount       INTEGER,
+            codec           TEXT,
+            dictId          INTEGER,
+            hash            BLOB,
+            contents        BLOB,
+            PRIMARY KEY (job_id, number, seq)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chunks (
+            hash            BLOB PRIMARY KEY,
+            codec           TEXT,
+            dictId          INTEGER,
+            contents        BLOB
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logdicts (
+            id              INTEGER PRIMARY KEY,
+            job_id          INTEGER NOT NULL,
+            contents        BLOB
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS kvetch (
+            job_id          INTEGER PRIMARY KEY,
+            target          TEXT,
+            build           INTEGER,
+            timestamp       INTEGER,
+            level           INTEGER
+        )
+    ''')
+
+    # watermark is the highest build number synced, running the in
+    # progress build numbers (JSON list) still to be synced.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync (
+            job_id          INTEGER PRIMARY KEY,
+            watermark       INTEGER,
+            running         TEXT
+        )
+    ''')
+
+    # Scan logs (JSON) by scan log plugin path and function name, with the
+    # fingerprint of the plugin that produced them. scanners has the
+    # current fingerprint of each scan log function.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scan_results (
+            job_id          INTEGER NOT NULL,
+            number          INTEGER NOT NULL,
+            scanner         TEXT NOT NULL,
+            fingerprint     TEXT,
+            result          TEXT,
+            PRIMARY KEY (job_id, number, scanner)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scanners (
+            name            TEXT PRIMARY KEY,
+            fingerprint     TEXT
+        )
+    ''')
+
+    # Error relevant lines of the build logs are indexed in log_search
+    # for -g, log_search_builds has the builds that have been indexed.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS log_search_builds (
+            job_id          INTEGER NOT NULL,
+            number          INTEGER NOT NULL,
+            PRIMARY KEY (job_id, number)
+        ) WITHOUT ROWID
+    ''')
+    db_create_log_search()
+
+    # Failures by the signature of their scan log, see Failure signatures.
+    # Timestamps are the build timestamps.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS failures (
+            signature       BLOB PRIMARY KEY,
+            firstSeen       INTEGER,
+            lastSeen        INTEGER,
+            count           INTEGER,
+            sample          TEXT
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS failure_builds (
+            signature       BLOB NOT NULL,
+            job_id          INTEGER NOT NULL,
+            number          INTEGER NOT NULL,
+            PRIMARY KEY (signature, job_id, number)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS failure_builds_build
+        ON failure_builds (job_id, number)
+    ''')
+
+    # Job names (JSON list) of each view when it was last loaded
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS views (
+            name            TEXT PRIMARY KEY,
+            jobs            TEXT
+        )
+    ''')
+
+#
+# Version 1 keyed every table by the fullDisplayName string (or the job
+# name). The old tables are renamed, copied into the version 2 tables and
+# dropped, all in the caller's transaction. Tables version 1 databases only
+# have when they were created by a later dev build are copied if present.
+#
+def split_full_display_name(fullDisplayName):
+    name, sep, num = fullDisplayName.rpartition(' #')
+    if (not sep or not num.isdigit()):
+        return (None, None)
+    return (name.replace(" » ", "/"), int(num))
+
+def db_migrate_v1():
+    conn.create_function('job_of', 1,
+                         lambda s: split_full_display_name(s)[0],
+                         deterministic=True)
+    conn.create_function('number_of', 1,
+                         lambda s: split_full_display_name(s)[1],
+                         deterministic=True)
+
+    tables = [ row[0] for row in cursor.execute('''
+        SELECT name FROM sqlite_master WHERE type = 'table'
+    ''').fetchall() ]
+    old = [ t for t in ('builds','logfiles','logchunks','logdicts',
+                        'kvetch','sync') if t in tables ]
+    for table in old:
+        cursor.execute(f'ALTER TABLE {table} RENAME TO v1_{table}')
+    if ('logchunks' in old):
+        db_add_missing_column('v1_logchunks','firstLine','INTEGER')
+        db_add_missing_column('v1_logchunks','lineCount','INTEGER')
+        db_add_missing_column('v1_logchunks','codec','TEXT')
+        db_add_missing_column('v1_logchunks','dictId','INTEGER')
+        db_add_missing_column('v1_logchunks','hash','BLOB')
+    create_tables()
+
+    names = [ f'SELECT job_of(fullDisplayName) AS name FROM v1_{t}'
+              for t in ('builds','logfiles','logchunks') if t in old ]
+    names += [ f'SELECT jobName AS name FROM v1_{t}'
+               for t in ('logdicts','kvetch','sync') if t in old ]
+    if (names):
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO jobs (name)
+            SELECT name FROM ({' UNION '.join(names)})
+            WHERE name IS NOT NULL
+        ''')
+
+    # Each version 2 column list, and the expression selecting it from a
+    # version 1 row aliased o, where j is the job of the row.
+    key = 'j.id, number_of(o.fullDisplayName)'
+    copies = {
+        'builds': ('job_id,number,fullDisplayName,description,result,'
+                   'duration,timestamp,url,changeSets,claims',
+                   key + ', o.fullDisplayName, o.description, o.result, '
+                   'o.duration, o.timestamp, o.url, o.changeSets, o.claims',
+                   'job_of(o.fullDisplayName)'),
+        'logfiles': ('job_id,number,contents',
+                     key + ', o.contents',
+                     'job_of(o.fullDisplayName)'),
+        'logchunks': ('job_id,number,seq,firstLine,lineCount,codec,dictId,'
+                      'hash,contents',
+                      key + ', o.seq, o.firstLine, o.lineCount, o.codec, '
+                      'o.dictId, o.hash, o.contents',
+                      'job_of(o.fullDisplayName)'),
+        'logdicts': ('id,job_id,contents',
+                     'o.id, j.id, o.contents',
+                     'o.jobName'),
+        'kvetch': ('job_id,target,build,timestamp,level',
+                   'j.id, o.target, o.build, o.timestamp, o.level',
+                   'o.jobName'),
+        'sync': ('job_id,watermark,running',
+                 'j.id, o.watermark, o.running',
+                 'o.jobName'),
+    }
+    for table in old:
+        columns, select, job = copies[table]
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO {table} ({columns})
+            SELECT {select}
+            FROM v1_{table} o JOIN jobs j ON j.name = {job}
+        ''')
+        cursor.execute(f'DROP TABLE v1_{table}')
+
+#
+# DB writer
+#
+# Small row writes are queued in order, and runs of the same statement
+# are written with executemany. The transaction is committed every
+# db_commit_builds recorded builds or db_commit_seconds seconds, so an
+# interrupted sync keeps what it has written. Reads that may look at rows
+# written earlier in the same run call db_flush first. Log chunk blobs are
+# written directly so queued rows stay small.
+#
+# A build being recorded is written inside a savepoint, between
+# db_begin_build and db_build_written, and no commit happens in between,
+# so a build is never committed without all of its log. db_abort_build
+# rolls back a build that failed.
+#
+db_commit_builds = 100
+db_commit_seconds = 30
+DB_QUEUE_ROWS = 1000
+
+db_queue = []   # [statement, list of parameters] in the order written
+db_queued_rows = 0
+db_pending_builds = 0
+db_last_commit = time.monotonic()
+db_build_open = False
+db_read_only = False    # set in scan workers, which must not convert logs
+
+def db_write(sql,params):
+    global db_queued_rows
+    if (db_queue and db_queue[-1][0] == sql):
+        db_queue[-1][1].append(params)
     else:
-        cursor.execute('SELECT version FROM schema')
-        row=cursor.fetchone()
-        curr_version=row[0]
-        if (curr_version != schema_version):
-            if (curr_version < schema_version):
-                print("Migrating Kvetch DB schema ver %d to %d"
-                      % (curr_version, schema_version))
-            else:
-                print("Reseting Kvetch DB schema ver %d to %d"
-                      % (curr_version, schema_version))
-                
-            cursor.execute("UPDATE schema set version = ?",
-                           (str(schema_version)))
-            conn.commit()
+        db_queue.append([sql,[params]])
+    db_queued_rows += 1
+    if (db_queued_rows >= DB_QUEUE_ROWS):
+        db_flush()
+
+def db_flush():
+    global db_queued_rows
+    for sql, rows in db_queue:
+        cursor.executemany(sql,rows)
+    db_queue.clear()
+    db_queued_rows = 0
+
+def db_maybe_commit():
+    if (not db_build_open and
+        (db_pending_builds >= db_commit_builds or
+         time.monotonic() - db_last_commit >= db_commit_seconds)):
+        commit_sqlite()
+
+def db_begin_build():
+    global db_build_open
+    db_flush()
+    if (not conn.in_transaction):
+        cursor.execute('BEGIN')
+    cursor.execute('SAVEPOINT build')
+    db_build_open = True
+
+def db_abort_build():
+    global db_build_open, db_queued_rows
+    if (db_build_open):
+        db_queue.clear()
+        db_queued_rows = 0
+        cursor.execute('ROLLBACK TO build')
+        cursor.execute('RELEASE build')
+        db_build_open = False
+        # Rows they point at may be gone
+        db_job_ids.clear()
+        log_dict_ids.clear()
+        zstd_compressors.clear()
+        zstd_decompressors.clear()
+
+def db_build_written():
+    global db_pending_builds, db_build_open
+    if (db_build_open):
+        db_flush()
+        cursor.execute('RELEASE build')
+        db_build_open = False
+    db_pending_builds += 1
+    db_maybe_commit()
+
+def db_add_missing_column(table,column,decl):
+    cursor.execute(f'PRAGMA table_info({table})')
+    if (not any(row[1] == column for row in cursor.fetchall())):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+#
+# Returns the id of a job in jobs, or None if it has none and create is
+# False. Ids are cached since nearly every query needs one.
+#
+db_job_ids = {}
+def db_job_id(job_name,create=False):
+    job_id = db_job_ids.get(job_name)
+    if (job_id is None):
+        if (create):
+            cursor.execute('''
+                INSERT OR IGNORE INTO jobs (name)
+                VALUES (?)
+            ''', (job_name,))
+        cursor.execute('''
+            SELECT id FROM jobs
+            WHERE name = ?
+        ''', (job_name,))
+        row = cursor.fetchone()
+        if (row is None):
+            return None
+        job_id = db_job_ids[job_name] = row[0]
+    return job_id
 
 def db_build_exists(job_info,build_info):
-    fullDisplayName=build_info['fullDisplayName']
+    job_id=db_job_id(job_info['name'])
+    if (job_id is None):
+        return False
+    db_flush()
     cursor.execute('''
         SELECT claims FROM builds
-        WHERE fullDisplayName = ?
-    ''', (fullDisplayName,))
+        WHERE job_id = ? AND number = ?
+    ''', (job_id,build_info['number']))
     row = cursor.fetchone()
     if (row):
         claims_str = json.dumps(build_info['claims'])
         if (row[0] != claims_str):
-            cursor.execute('''
+            db_write('''
                 UPDATE builds set claims = ?
-                WHERE fullDisplayName = ?
-            ''', (claims_str,fullDisplayName))
+                WHERE job_id = ? AND number = ?
+            ''', (claims_str,job_id,build_info['number']))
         return True
     else:
         return False
 
+def db_build_num_exists(job_name,build_num):
+    job_id=db_job_id(job_name)
+    if (job_id is None):
+        return False
+    db_flush()
+    cursor.execute('''
+        SELECT 1 FROM builds
+        WHERE job_id = ? AND number = ?
+    ''', (job_id,build_num))
+    return cursor.fetchone() is not None
+
+def db_job_has_builds(job_name):
+    job_id=db_job_id(job_name)
+    if (job_id is None):
+        return False
+    db_flush()
+    cursor.execute('''
+        SELECT 1 FROM builds
+        WHERE job_id = ?
+        LIMIT 1
+    ''', (job_id,))
+    return cursor.fetchone() is not None
+
+def db_update_claims(job_name,build_num,claims):
+    job_id=db_job_id(job_name)
+    if (job_id is None):
+        return
+    claims_str = json.dumps(claims)
+    db_write('''
+        UPDATE builds set claims = ?
+        WHERE job_id = ? AND number = ? AND claims != ?
+    ''', (claims_str,job_id,build_num,claims_str))
+
 def db_add_build(build_info):
+    job_id=db_job_id(build_info['name'],create=True)
+    number=build_info['number']
     fullDisplayName=build_info['fullDisplayName']
     description=build_info['description']
     result=build_info['result']
@@ -389,65 +1454,408 @@ def db_add_build(build_info):
     changeSets_str = json.dumps(build_info['changeSets'])
     claims_str = json.dumps(build_info['claims'])
 
-    cursor.execute('''
+    db_write('''
         INSERT INTO builds
-        (fullDisplayName,description,result,duration,timestamp,url,
-         changeSets,claims)
-        VALUES (?,?,?,?,?,?,?,?)
-    ''', (fullDisplayName,description,result,duration,timestamp,url,
-          changeSets_str,claims_str))
+        (job_id,number,fullDisplayName,description,result,duration,
+         timestamp,url,changeSets,claims)
+        VALUES (?,?,?,?,?,?,?,?,?,?)
+    ''', (job_id,number,fullDisplayName,description,result,duration,
+          timestamp,url,changeSets_str,claims_str))
+
+BUILD_COLUMNS = '''number,fullDisplayName,description,result,duration,
+                   timestamp,url,changeSets,claims'''
+
+def db_make_build_info(job_name,row):
+    build_info={}
+    build_info['name']            = job_name
+    build_info['number']          = row[0]
+    build_info['inProgress']      = False
+    build_info['fullDisplayName'] = row[1]
+    build_info['description']     = row[2]
+    build_info['result']          = row[3]
+    build_info['duration']        = row[4]
+    build_info['timestamp']       = row[5]
+    build_info['url']             = row[6]
+    build_info['changeSets']      = json.loads(row[7])
+    build_info['claims']          = json.loads(row[8])
+
+    return build_info
 
 def db_get_build_info(job_name,build_num):
-    fullDisplayName=get_full_display_name(job_name,build_num)
+    job_id=db_job_id(job_name)
+    if (job_id is None):
+        return None
 
-    cursor.execute('''
-        SELECT fullDisplayName,description,result,duration,timestamp,url,
-               changeSets,claims
+    db_flush()
+    cursor.execute(f'''
+        SELECT {BUILD_COLUMNS}
         FROM builds
-        WHERE fullDisplayName = ?
-    ''', (fullDisplayName,))
+        WHERE job_id = ? AND number = ?
+    ''', (job_id,build_num))
     row=cursor.fetchone()
     if (row is None):
         return None
-    build_info={}
-    build_info['name']            = job_name
-    build_info['number']          = build_num
-    build_info['inProgress']      = False
-    build_info['fullDisplayName'] = row[0]
-    build_info['description']     = row[1]
-    build_info['result']          = row[2]
-    build_info['duration']        = row[3]
-    build_info['timestamp']       = row[4]
-    build_info['url']             = row[5]
-    build_info['changeSets']      = json.loads(row[6])
-    build_info['claims']          = json.loads(row[7])
+    return db_make_build_info(job_name,row)
 
-    return build_info
+#
+# Yields the build infos of the builds of a job stored in the DB, in the
+# order of build_nums, with one query over the range of build numbers.
+# where is an extra SQL condition on the builds columns. Rows are decoded
+# only for the requested builds and as they are consumed.
+#
+def db_iter_builds(job_name,build_nums,where=None):
+    job_id=db_job_id(job_name)
+    if (job_id is None or not build_nums):
+        return
+    wanted = set(build_nums)
+    descending = build_nums[0] > build_nums[-1]
+    in_order = build_nums == sorted(build_nums,reverse=descending)
 
-def db_add_build_log(fullDisplayName,build_log):
-    compressed_log = zlib.compress(build_log.encode('utf-8'))
+    db_flush()
+    rows = conn.execute(f'''
+        SELECT {BUILD_COLUMNS}
+        FROM builds
+        WHERE job_id = ? AND number BETWEEN ? AND ?
+              {'AND (' + where + ')' if where else ''}
+        ORDER BY number {'DESC' if descending else 'ASC'}
+    ''', (job_id,min(wanted),max(wanted)))
+    if (in_order):
+        for row in rows:
+            if (row[0] in wanted):
+                yield db_make_build_info(job_name,row)
+    else:
+        found = { row[0]: row for row in rows if row[0] in wanted }
+        for build_num in build_nums:
+            if (build_num in found):
+                yield db_make_build_info(job_name,found[build_num])
+
+#
+# Log codecs
+#
+# Each log frame records the codec it was compressed with, so frames
+# written with different codecs stay readable. NULL is zlib. With zstd, a
+# dictionary is trained per job from its first LOG_DICT_SAMPLES stored
+# logs and kept in logdicts. Jenkins logs of the same job are nearly
+# identical, so later frames compress against it much better.
+#
+log_codec = 'zlib'
+LOG_DICT_SAMPLES = 8
+LOG_DICT_SAMPLE_SIZE = 16*1024
+LOG_DICT_LOG_BYTES = 2*1024*1024  # Sampled from each log
+LOG_DICT_SIZE = 256*1024
+
+log_dict_ids = {}       # job id -> dictionary id
+log_dict_attempts = {}  # job id -> logs stored without a dictionary
+zstd_compressors = {}
+zstd_decompressors = {}
+
+def db_get_log_dict(dict_id):
     cursor.execute('''
-        INSERT INTO logfiles
-        (fullDisplayName,contents)
-        VALUES (?,?)
-    ''', (fullDisplayName,compressed_log))
+        SELECT contents FROM logdicts
+        WHERE id = ?
+    ''', (dict_id,))
+    return zstandard.ZstdCompressionDict(cursor.fetchone()[0])
+
+def get_zstd_compressor(dict_id):
+    if (dict_id not in zstd_compressors):
+        dict_data = db_get_log_dict(dict_id) if dict_id else None
+        zstd_compressors[dict_id] = zstandard.ZstdCompressor(
+            level=3, dict_data=dict_data)
+    return zstd_compressors[dict_id]
+
+def get_zstd_decompressor(dict_id):
+    if (dict_id not in zstd_decompressors):
+        dict_data = db_get_log_dict(dict_id) if dict_id else None
+        zstd_decompressors[dict_id] = zstandard.ZstdDecompressor(
+            dict_data=dict_data)
+    return zstd_decompressors[dict_id]
+
+def db_train_log_dict(job_id):
+    samples = []
+    db_flush()
+    logs = conn.execute('''
+        SELECT number FROM logfiles
+        WHERE job_id = ?
+        LIMIT ?
+    ''', (job_id,LOG_DICT_SAMPLES)).fetchall()
+    if (len(logs) < LOG_DICT_SAMPLES):
+        return None
+    for (build_num,) in logs:
+        db_build_log_exists(job_id,build_num)
+        size = 0
+        for frame in db_iter_log_frames(job_id,build_num):
+            for i in range(0,len(frame),LOG_DICT_SAMPLE_SIZE):
+                samples.append(frame[i:i+LOG_DICT_SAMPLE_SIZE])
+            size += len(frame)
+            if (size >= LOG_DICT_LOG_BYTES):
+                break
+    try:
+        dict_data = zstandard.train_dictionary(LOG_DICT_SIZE,samples)
+    except zstandard.ZstdError as e:
+        print(f"Unable to train log dictionary for job {job_id}: {e}")
+        return None
+    cursor.execute('''
+        INSERT INTO logdicts (job_id, contents)
+        VALUES (?, ?)
+    ''', (job_id,dict_data.as_bytes()))
+    return cursor.lastrowid
 
-def db_get_build_log(job_name,build_num):
-    fullDisplayName=get_full_display_name(job_name,build_num)
+#
+# Picks the dictionary for the next log of a job. Jobs without one try to
+# train it every LOG_DICT_SAMPLES logs until they have enough samples.
+#
+def get_log_dict_id(job_id):
+    if (log_codec != 'zstd'):
+        return None
+    dict_id = log_dict_ids.get(job_id)
+    if (dict_id is None):
+        attempts = log_dict_attempts.get(job_id,0)
+        log_dict_attempts[job_id] = attempts + 1
+        if (attempts % LOG_DICT_SAMPLES == 0):
+            cursor.execute('''
+                SELECT MAX(id) FROM logdicts
+                WHERE job_id = ?
+            ''', (job_id,))
+            dict_id = cursor.fetchone()[0]
+            if (dict_id is None):
+                dict_id = db_train_log_dict(job_id)
+            log_dict_ids[job_id] = dict_id
+    return dict_id
+
+# Returns (codec, dictionary id, compressed data)
+def log_compress(dict_id,data):
+    if (log_codec == 'zstd'):
+        return ('zstd', dict_id, get_zstd_compressor(dict_id).compress(data))
+    return (None, None, zlib.compress(data))
+
+def log_decompress(codec,dict_id,data):
+    if (codec is None or codec == 'zlib'):
+        return zlib.decompress(data)
+    if (codec == 'zstd'):
+        if (zstandard is None):
+            raise RuntimeError("zstandard is needed to read zstd logs")
+        return get_zstd_decompressor(dict_id).decompress(data)
+    raise RuntimeError(f"Unknown log codec {codec}")
+
+#
+# Logs are stored as frames in logchunks: runs of whole lines of at most
+# LOG_CHUNK_SIZE bytes (longer lines are split). firstLine is the number of
+# the line the frame starts in and lineCount the number of newlines in it,
+# so a line range or the tail of a log can be read without decompressing
+# the frames before it.
+#
+# Frame boundaries are content defined: after at least LOG_CDC_MIN_SIZE
+# bytes, a frame ends after the first line whose hash has the LOG_CDC_MASK
+# bits clear. Sections shared between builds (checkout, environment dumps,
+# downloads) then split into identical frames, which are compressed and
+# stored once in chunks, keyed by their SHA-256, and referenced by hash
+# from logchunks.
+#
+# The logfiles row of a framed log has NULL contents. Older logs are a
+# single compressed blob in logfiles and are converted to frames the first
+# time they are read. Frames stored before deduplication keep their
+# contents in logchunks.
+#
+LOG_CDC_MIN_SIZE = 16*1024
+LOG_CDC_MASK = 0xff
+
+#
+# Returns the end of the frame starting at offset base of buf, or None if
+# buf does not hold all of it yet
+#
+def find_log_frame_end(buf,base=0):
+    limit = base + LOG_CHUNK_SIZE
+    pos = buf.find(b'\n', base + min(LOG_CDC_MIN_SIZE,LOG_CHUNK_SIZE) - 1)
+    start = max(buf.rfind(b'\n', base, pos) + 1, base)
+    while (0 <= pos < limit):
+        if (zlib.crc32(memoryview(buf)[start:pos]) & LOG_CDC_MASK == 0):
+            return pos + 1
+        start = pos + 1
+        pos = buf.find(b'\n', start)
+    if (len(buf) < limit):
+        return None
+    end = buf.rfind(b'\n', base, limit) + 1
+    if (end == 0):
+        end = limit
+    return end
+
+def iter_log_frames(chunks):
+    buf = b''
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        while (True):
+            end = find_log_frame_end(buf,start)
+            if (end is None):
+                break
+            yield buf[start:end]
+            start = end
+        buf = buf[start:]
+    if (buf):
+        yield buf
+
+def db_add_log_frames(job_id,build_num,frames):
+    line = 0
+    dict_id = get_log_dict_id(job_id)
+    for seq, frame in enumerate(frames):
+        count = frame.count(b'\n')
+        digest = hashlib.sha256(frame).digest()
+        cursor.execute('''
+            SELECT 1 FROM chunks
+            WHERE hash = ?
+        ''', (digest,))
+        if (cursor.fetchone() is None):
+            codec, dict_id, contents = log_compress(dict_id,frame)
+            cursor.execute('''
+                INSERT INTO chunks
+                (hash,codec,dictId,contents)
+                VALUES (?,?,?,?)
+            ''', (digest,codec,dict_id,contents))
+        db_write('''
+            INSERT INTO logchunks
+            (job_id,number,seq,firstLine,lineCount,hash)
+            VALUES (?,?,?,?,?,?)
+        ''', (job_id,build_num,seq,line,count,digest))
+        line += count
+
+#
+# Yields the decompressed frames of a log starting at frame start_seq
+#
+def db_iter_log_frames(job_id,build_num,start_seq=0):
+    frames = conn.execute('''
+        SELECT IFNULL(c.codec,l.codec), IFNULL(c.dictId,l.dictId),
+               IFNULL(c.contents,l.contents)
+        FROM logchunks l LEFT JOIN chunks c ON c.hash = l.hash
+        WHERE l.job_id = ? AND l.number = ? AND l.seq >= ?
+        ORDER BY l.seq
+    ''', (job_id,build_num,start_seq))
+    for codec, dict_id, contents in frames:
+        yield log_decompress(codec,dict_id,contents)
+
+#
+# With scanner, the text of the log is also fed to it as it is stored
+#
+def db_add_build_log(job_name,build_num,build_log,scanners=()):
+    job_id = db_job_id(job_name,create=True)
+    db_write('''
+        INSERT INTO logfiles
+        (job_id,number,contents)
+        VALUES (?,?,NULL)
+    ''', (job_id,build_num))
+    chunks = iter(lambda: build_log.read(LOG_CHUNK_SIZE), b'')
+    frames = iter_log_frames(chunks)
+    if (scanners):
+        frames = feed_frames(scanners,frames)
+    db_add_log_frames(job_id,build_num,frames)
+
+def db_migrate_build_log(job_id,build_num,contents):
+    decompressor = zlib.decompressobj()
+
+    def chunks():
+        data = contents
+        while (data):
+            yield decompressor.decompress(data,LOG_CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+
+    db_add_log_frames(job_id,build_num,iter_log_frames(chunks()))
     cursor.execute('''
+        UPDATE logfiles set contents = NULL
+        WHERE job_id = ? AND number = ?
+    ''', (job_id,build_num))
+    db_flush()
+    db_maybe_commit()
+
+def db_build_log_exists(job_id,build_num):
+    if (job_id is None):
+        return False
+    db_flush()
+    row=conn.execute('''
         SELECT contents
         FROM logfiles
-        WHERE fullDisplayName = ?
-    ''', (fullDisplayName,))
-    row=cursor.fetchone()
-    build_log=zlib.decompress(row[0]).decode('utf-8')
-    return build_log
+        WHERE job_id = ? AND number = ?
+    ''', (job_id,build_num)).fetchone()
+    if (row is None):
+        return False
+    if (row[0] is not None):
+        if (db_read_only):
+            raise RuntimeError(f"Build log {build_num} is not converted")
+        db_migrate_build_log(job_id,build_num,row[0])
+    return True
+
+#
+# Yields the text of lines first_line up to (not including) last_line of a
+# build log, or of the whole log, a frame at a time.
+#
+def db_iter_build_log(job_name,build_num,first_line=0,last_line=None):
+    job_id=db_job_id(job_name)
+    if (not db_build_log_exists(job_id,build_num)):
+        return
+
+    row=conn.execute('''
+        SELECT seq, firstLine
+        FROM logchunks
+        WHERE job_id = ? AND number = ? AND firstLine < ?
+        ORDER BY seq DESC LIMIT 1
+    ''', (job_id,build_num,first_line)).fetchone()
+    start_seq, line = row if row else (0, 0)
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for frame in db_iter_log_frames(job_id,build_num,start_seq):
+        text = decoder.decode(frame)
+        start = 0
+        while (line < first_line):
+            nl = text.find('\n',start)
+            if (nl < 0):
+                break
+            start = nl + 1
+            line += 1
+        if (line < first_line):
+            continue
+
+        end = start
+        while (last_line is None or line < last_line):
+            nl = text.find('\n',end)
+            if (nl < 0):
+                break
+            end = nl + 1
+            line += 1
+        if (last_line is not None and line >= last_line):
+            yield text[start:end]
+            return
+        yield text[start:]
+    yield decoder.decode(b'', final=True)
+
+def db_count_build_log_lines(job_name,build_num):
+    job_id=db_job_id(job_name)
+    if (not db_build_log_exists(job_id,build_num)):
+        return 0
+    row=conn.execute('''
+        SELECT seq, firstLine, lineCount
+        FROM logchunks
+        WHERE job_id = ? AND number = ?
+        ORDER BY seq DESC LIMIT 1
+    ''', (job_id,build_num)).fetchone()
+    if (row is None):
+        return 0
+    count = row[1] + row[2]
+    last_frame = next(db_iter_log_frames(job_id,build_num,row[0]))
+    if (not last_frame.endswith(b'\n')):
+        count += 1
+    return count
+
+def db_iter_build_log_tail(job_name,build_num,n):
+    first_line = max(0, db_count_build_log_lines(job_name,build_num) - n)
+    return db_iter_build_log(job_name,build_num,first_line)
+
+def db_get_build_log(job_name,build_num):
+    return ''.join(db_iter_build_log(job_name,build_num))
 
 def db_get_kvetch_info(job_name):
+    db_flush()
     cursor.execute('''
-        SELECT jobName, target, build, timestamp, level
-        FROM kvetch
-        WHERE jobName = ?
+        SELECT j.name, k.target, k.build, k.timestamp, k.level
+        FROM kvetch k JOIN jobs j ON j.id = k.job_id
+        WHERE j.name = ?
     ''', (job_name,))
     row=cursor.fetchone()
     if (not row):
@@ -462,38 +1870,134 @@ def db_get_kvetch_info(job_name):
         return kvetch_info
 
 def db_set_kvetch_info(kvetch_info):
-    cursor.execute('''
-        INSERT INTO kvetch (jobName, target, build, timestamp, level)
+    db_write_kvetch_info(kvetch_info)
+    db_maybe_commit()
+
+def db_write_kvetch_info(kvetch_info):
+    db_write('''
+        INSERT INTO kvetch (job_id, target, build, timestamp, level)
         VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(jobName) DO UPDATE SET
+        ON CONFLICT(job_id) DO UPDATE SET
             target    = excluded.target,
             build     = excluded.build,
             timestamp = excluded.timestamp,
             level     = excluded.level
-    ''', (kvetch_info['jobName'],
+    ''', (db_job_id(kvetch_info['jobName'],create=True),
           kvetch_info['target'],
           kvetch_info['build'],
           kvetch_info['timestamp'],
           kvetch_info['level']))
-    conn.commit()
+
+def db_set_view_jobs(view_name,job_names):
+    db_write('''
+        INSERT OR REPLACE INTO views (name, jobs)
+        VALUES (?, ?)
+    ''', (view_name,json.dumps(job_names)))
+
+def db_get_sync_info(job_name):
+    db_flush()
+    cursor.execute('''
+        SELECT j.name, s.watermark, s.running
+        FROM sync s JOIN jobs j ON j.id = s.job_id
+        WHERE j.name = ?
+    ''', (job_name,))
+    row=cursor.fetchone()
+    if (not row):
+        return None
+    else:
+        sync_info = {}
+        sync_info['jobName']   = row[0]
+        sync_info['watermark'] = row[1]
+        sync_info['running']   = json.loads(row[2])
+        return sync_info
+
+def db_set_sync_info(sync_info):
+    db_write('''
+        INSERT INTO sync (job_id, watermark, running)
+        VALUES (?, ?, ?)
+        ON CONFLICT(job_id) DO UPDATE SET
+            watermark = excluded.watermark,
+            running   = excluded.running
+    ''', (db_job_id(sync_info['jobName'],create=True),
+          sync_info['watermark'],
+          json.dumps(sync_info['running'])))
+
+#
+# Drops the cached scan logs of a scan log function when its plugin has
+# changed. Other scanners keep theirs.
+#
+def db_check_scanner(scanner,fingerprint):
+    cursor.execute('''
+        SELECT fingerprint FROM scanners
+        WHERE name = ?
+    ''', (scanner,))
+    row=cursor.fetchone()
+    if (row and row[0] == fingerprint):
+        return
+    cursor.execute('''
+        DELETE FROM scan_results
+        WHERE scanner = ? AND fingerprint != ?
+    ''', (scanner,fingerprint))
+    cursor.execute('''
+        INSERT INTO scanners (name, fingerprint)
+        VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            fingerprint = excluded.fingerprint
+    ''', (scanner,fingerprint))
+
+def db_get_scan_result(job_name,build_num,scanner,fingerprint):
+    job_id=db_job_id(job_name)
+    if (job_id is None):
+        return None
+    db_flush()
+    cursor.execute('''
+        SELECT result FROM scan_results
+        WHERE job_id = ? AND number = ? AND scanner = ? AND fingerprint = ?
+    ''', (job_id,build_num,scanner,fingerprint))
+    row=cursor.fetchone()
+    if (row is None):
+        return None
+    return json.loads(row[0])
+
+def db_set_scan_result(job_name,build_num,scanner,fingerprint,s):
+    try:
+        result = json.dumps(s)
+    except TypeError:
+        return # Not cached
+    db_write('''
+        INSERT OR REPLACE INTO scan_results
+        (job_id,number,scanner,fingerprint,result)
+        VALUES (?,?,?,?,?)
+    ''', (db_job_id(job_name,create=True),build_num,scanner,fingerprint,
+          result))
+    db_maybe_commit()
 
 def commit_sqlite():
+    global db_pending_builds, db_last_commit, db_build_open
+    db_flush()
     conn.commit()
+    db_build_open = False
+    db_pending_builds = 0
+    db_last_commit = time.monotonic()
 
 def close_sqlite():
     conn.close()    
 
-def db_for_each_build(job_infos, build_pred, callback,f):
+#
+# Build predicates that can be run by the DB as a condition on builds
+#
+db_build_filters = {}
+
+def db_select_builds(job_infos, build_pred):
+   where = db_build_filters.get(build_pred)
+   if (where):
+       build_pred = None
    for job_info in job_infos:
         try:
             job_name=job_info['name']
             builds = job_info['builds']
                     
-            for build in builds:
-                build_info = db_get_build_info(job_name,build)
-                if (build_info is None):
-                    continue
-
+            for build_info in db_iter_builds(job_name,builds,where):
                 if (build_pred):
                     pred=build_pred(job_info,build_info)
                     if (pred is None):
@@ -501,12 +2005,27 @@ def db_for_each_build(job_infos, build_pred, callback,f):
                     if (pred):
                         continue
                 
-                callback(f,job_info,build_info)
+                yield (job_info,build_info)
 
         except jenkins.JenkinsException as e:
-            print("%s has no jobs available" % job['name'])
+            print("%s has no jobs available" % job_info['name'])
             print(f"{e}")
 
+#
+# With scan_pred, the build logs scan_pred accepts are scanned and the
+# callback gets the scan log as 4th argument, None for the others.
+#
+def db_for_each_build(job_infos, build_pred, callback,f,scan_pred=None):
+    builds = db_select_builds(job_infos, build_pred)
+    if (scan_pred is None):
+        for job_info, build_info in builds:
+            callback(f,job_info,build_info)
+    else:
+        parallel = count_builds(job_infos) > 1
+        for (job_info, build_info), s in db_scan_builds(builds, scan_pred,
+                                                        parallel):
+            callback(f,job_info,build_info,s)
+
 def count_builds(job_infos):
     count = 0
     for job_info in job_infos:
@@ -600,13 +2119,89 @@ def send_email(to_email, cc_email, subject, body, mode):
             msg['Cc'] = cc_email
 
     msg.set_content(body)
+    print_mail_results()
+    get_mail_pool().submit(deliver_email, msg)
 
-    try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.send_message(msg)
-        print("✅ Email sent successfully.")
-    except Exception as e:
-        print(f"❌ Failed to send email: {e}")
+#
+# Mail queue
+#
+# Emails are queued to a single mail thread that keeps one SMTP session
+# open for the whole run, so reports do not wait on the mail server. A
+# send that fails with a transient error is retried on a new session,
+# after mail_retry_delay seconds, doubled for each retry. finish() waits
+# for the queued emails to be sent. The mail thread hands the outcome of
+# each email to the main thread in mail_results, which prints them to
+# stderr, away from the reports.
+#
+mail_retries=3
+mail_retry_delay=5
+mail_pool=None
+mail_session=None
+mail_results=queue.SimpleQueue()
+
+def get_mail_pool():
+    global mail_pool
+    if (mail_pool is None):
+        mail_pool = ThreadPoolExecutor(max_workers=1,
+                                       thread_name_prefix="kvetch-mail")
+    return mail_pool
+
+def close_mail_pool():
+    global mail_pool
+    if (mail_pool):
+        mail_pool.submit(close_mail_session)
+        mail_pool.shutdown()
+        mail_pool = None
+    print_mail_results()
+
+#
+# Ends the SMTP session once the queued emails are sent, for runs that
+# wait for their next cycle
+#
+def release_mail_session():
+    if (mail_pool):
+        mail_pool.submit(close_mail_session)
+
+def close_mail_session():
+    global mail_session
+    if (mail_session):
+        try:
+            mail_session.quit()
+        except (smtplib.SMTPException, OSError):
+            mail_session.close()
+        mail_session = None
+
+def print_mail_results():
+    while (not mail_results.empty()):
+        print(mail_results.get(), file=sys.stderr)
+
+def is_transient_mail_error(e):
+    if (isinstance(e, smtplib.SMTPResponseException)):
+        return 400 <= e.smtp_code < 500
+    if (isinstance(e, smtplib.SMTPRecipientsRefused)):
+        return False
+    return isinstance(e, (smtplib.SMTPException, OSError))
+
+def deliver_email(msg):
+    global mail_session
+    delay = mail_retry_delay
+    for attempt in range(mail_retries + 1):
+        try:
+            if (mail_session is None):
+                mail_session = smtplib.SMTP(smtp_server, smtp_port)
+            mail_session.send_message(msg)
+            mail_results.put("✅ Email sent successfully.")
+            return
+        except Exception as e:
+            close_mail_session()
+            if (attempt == mail_retries or not is_transient_mail_error(e)):
+                mail_results.put(f"❌ Failed to send email: {e}")
+                return
+            # An idle session closed by the server is reopened right away
+            if (attempt > 0 or
+                not isinstance(e, smtplib.SMTPServerDisconnected)):
+                time.sleep(delay)
+                delay *= 2
 
 def merge_emails(a,b):
     if (a):
@@ -618,8 +2213,12 @@ def merge_emails(a,b):
         return b
 
 #
-# Load user defined function
+# Load user defined function. Plugins can import kvetch to use its
+# helpers; when kvetch is run as a script that is this module.
 #
+if __name__ == "__main__":
+    sys.modules.setdefault('kvetch', sys.modules[__name__])
+
 def load_func_from_file(file_path, function_name):
     """
     Loads a function from a Python file given its path and function name.
@@ -646,8 +2245,17 @@ def init(org_path):
     connect_jenkins()
     init_org(org_path)
     init_sqlite()
+    init_http_cache()
+    if (scan_log_key):
+        db_check_scanner(scan_log_key,scan_log_fingerprint)
 
 def finish():
+    close_fetch_pool()
+    close_jenkins_loop()
+    close_scan_pool()
+    close_mail_pool()
+    close_http_cache()
+    commit_sqlite()
     close_sqlite()
 
 def print_json(f,dict):
@@ -697,11 +2305,16 @@ def skip_build(job_info,build_info):
     skip_count=0
     return False # Do not skip
 
+def skip_existing(job_info,build_info):
+    return db_build_exists(job_info,build_info)
+
 first_record=True
-def record_build(f,job_info,build_info):
+running_builds=[]
+def record_build(f,job_info,build_info,build_log):
     global first_record
 
     if (build_info['inProgress']):
+        running_builds.append(build_info['number'])
         return
 
     if (first_record):
@@ -710,11 +2323,135 @@ def record_build(f,job_info,build_info):
 
     print_build_internal(f,job_info,build_info,False)
 
-    build_log = get_build_console(build_info['name'],build_info['number'])
-    db_add_build(build_info)
-    db_add_build_log(build_info['fullDisplayName'],build_log)
+    db_begin_build()
+    try:
+        db_add_build(build_info)
+        name=build_info['name']
+        number=build_info['number']
+        scanner = None
+        if (scan_on_sync and scan_log_scanner):
+            scanner = new_scanner()
+        indexer = None
+        if (search_on_sync):
+            indexer = new_log_search_indexer(name,number)
+        db_add_build_log(name,number,build_log,
+                         [ s for s in (scanner,indexer) if s ])
+        if (scanner):
+            store_recorded_scan(build_info,scanner)
+        if (indexer and not indexer.error):
+            indexer.finish()
+    except BaseException:
+        db_abort_build()
+        raise
+    finally:
+        build_log.close()
+    db_build_written()
     return
 
+#
+# The log of a recorded build is scanned as it is compressed, and the
+# scan log is stored in scan_results, so reports do not have to read the
+# log. A failing scan is left to the reports to retry.
+#
+scan_on_sync = True
+def store_recorded_scan(build_info,scanner):
+    try:
+        if (scanner.error):
+            raise scanner.error
+        s = scanner.finish()
+    except Exception as e:
+        print(f"Unable to scan {build_info['fullDisplayName']}: {e}")
+        return
+    db_set_scan_result(build_info['name'],build_info['number'],
+                       scan_log_key,scan_log_fingerprint,s)
+    db_add_failure(build_info,s)
+
+#
+# Sync the DB with Jenkins. Each job remembers the highest build number
+# synced and the builds that were still running, so only builds above the
+# watermark and the remembered running builds are fetched. Jobs synced
+# before the watermark existed fall back to skip_build. A job new to the
+# DB starts at watermark 0 right away, so an interrupted first backfill
+# resumes where it stopped.
+#
+def sync_builds(job_infos,f):
+    ret = False # Indicates if any build was recorded
+    synced = [] # The job infos synced without error
+    for job_info in job_infos:
+        job_name=job_info['name']
+        try:
+            sync_info = db_get_sync_info(job_name)
+            if (sync_info is None and not db_job_has_builds(job_name)):
+                sync_info = { 'jobName': job_name, 'watermark': 0,
+                              'running': [] }
+                db_set_sync_info(sync_info)
+
+            if (sync_info is None):
+                sync_info = { 'jobName': job_name, 'watermark': 0 }
+                builds = job_info['builds']
+                build_pred = skip_build
+            else:
+                running = set(sync_info['running'])
+                builds = [ b for b in job_info['builds']
+                           if (b > sync_info['watermark'] or b in running)
+                           and not db_build_num_exists(job_name,b) ]
+                build_pred = skip_existing
+
+            db_sync_last_failed_claims(job_name)
+
+            running_builds.clear()
+            if (for_each_job_build(dict(job_info, builds=builds),
+                                   build_pred, record_build, f,
+                                   fetch_log=True)):
+                ret=True
+
+            sync_info['watermark'] = max(job_info['builds'],
+                                         default=sync_info['watermark'])
+            sync_info['running'] = list(running_builds)
+            db_set_sync_info(sync_info)
+            synced.append(job_info)
+
+        except (jenkins.JenkinsException, requests.RequestException) as e:
+            print("%s has no jobs available" % job_name)
+            print(f"{e}")
+    return ret, synced
+
+#
+# Watch mode
+#
+# With -w, kvetch keeps running and repeats the sync and the report every
+# interval, with the Jenkins connection, org chart, scan log plugin and DB
+# kept open between cycles. The jobs of the views are fetched again each
+# cycle, with one request per view, and only the jobs whose last builds
+# changed since their last sync are synced. The claims of the others are
+# still brought up to date from the view.
+#
+watch_last_builds={}
+def changed_jobs(job_infos):
+    changed=[]
+    for job_info in job_infos:
+        job_name=job_info['name']
+        last_builds=tuple(job_info[p] for p in JOB_POINTERS)
+        if (watch_last_builds.get(job_name) != last_builds):
+            changed.append(job_info)
+        else:
+            db_sync_last_failed_claims(job_name)
+    return changed
+
+def watch_synced(job_infos):
+    for job_info in job_infos:
+        watch_last_builds[job_info['name']] = tuple(job_info[p]
+                                                    for p in JOB_POINTERS)
+
+def db_sync_last_failed_claims(job_name):
+    real_job_info = job_info_cache.get(job_name)
+    if (real_job_info is None):
+        return
+    last_failed = real_job_info.get('lastFailedBuild')
+    if (last_failed and 'actions' in last_failed):
+        db_update_claims(job_name,last_failed['number'],
+                         get_claims(last_failed['actions']))
+
 def debug_print_job_names(job_names):
     for item in job_names:
         print(item)
@@ -806,9 +2543,10 @@ def print_build(f,job_info,build_info):
     
 #
 # print build status is an optimized version of print_build that avoids
-# loading the build info for successful builds.
+# loading the build info for successful builds. build_infos may hold the
+# already fetched lastCompletedBuild of each job (see get_jobs_status).
 #
-def print_jobs_status(f,job_infos):
+def print_jobs_status(f,job_infos,build_infos=None):
     for ji in job_infos:
         name=ji['name']
         ls=ji['lastSuccessfulBuild']
@@ -818,7 +2556,11 @@ def print_jobs_status(f,job_infos):
                 print("%-40s #%-4d : " % (name,lc),end='',file=f)
                 print("SUCCESS",file=f)
             else:
-                build_info = get_build_info(name,lc)
+                build_info = None
+                if (build_infos):
+                    build_info = build_infos.get(name)
+                if (build_info is None):
+                    build_info = get_build_info(name,lc)
                 print_build_internal(f,ji,build_info, False)
         else:
             print("%-47s: UNKNOWN" % name, file=f)
@@ -827,17 +2569,638 @@ def truncate_to_n_lines(s, n):
     lines = s.splitlines()
     return '\n'.join(lines[:n])
 
-scan_log_func = None
+#
+# A PatternSet dispatches the lines of a log to actions. Each line is
+# matched against a list of (pattern, action) pairs and handled by the
+# first pattern, in list order, that searches successfully. A prefix
+# pattern, such as a timestamp, can be matched at the start of each line
+# first; the patterns are then searched in the rest of the line.
+#
+# scan() finds candidate lines in a whole block of text in a few passes
+# in C: all the patterns anchored with ^ are combined into one
+# alternation that follows a newline, and the others are searched one at
+# a time. Only the candidate lines are then matched line by line to pick
+# the first pattern. Patterns that could match differently in a block
+# than in a single line (other anchors, word boundaries, lookarounds,
+# back references) make scan() match every line.
+#
+# Scan log plugins use it with:
+#
+#     from kvetch import PatternSet
+#
+PATTERN_TOKEN = re.compile(r'\\.|\[\^?\]?(?:\\.|[^\]\\])*\]|.', re.S)
+
+class PatternSet:
+    FLAGS = { re.IGNORECASE: 'i', re.DOTALL: 's' }
+
+    def __init__(self, pattern_actions=(), prefix=''):
+        self.prefix = re.compile(prefix)
+        self.patterns = []
+        self.finders = None
+        for pattern, action in pattern_actions:
+            self.add(pattern, action)
+
+    def add(self, pattern, action):
+        self.patterns.append((re.compile(pattern), action))
+        self.finders = None
+
+    @staticmethod
+    def block_safe(source):
+        tokens = PATTERN_TOKEN.findall(source)
+        for i, token in enumerate(tokens):
+            if (token in ('^', '$', r'\A', r'\Z', r'\b', r'\B') or
+                (token[0] == '\\' and token[1:].isdigit()) or
+                (token == '(' and tokens[i+1:i+2] == ['?'] and
+                 tokens[i+2:i+3] != [':'])):
+                return False
+        return True
+
+    def compile(self):
+        self.finders = []
+        anchored = []
+        for pattern, action in self.patterns:
+            flags = pattern.flags & ~re.UNICODE
+            source = pattern.pattern
+            is_anchored = source.startswith('^')
+            if (is_anchored):
+                source = source[1:]
+            if (flags & ~sum(self.FLAGS) or not self.block_safe(source)):
+                self.finders = False
+                return
+            letters = ''.join(l for f, l in self.FLAGS.items() if flags & f)
+            if (letters):
+                source = f'(?{letters}:{source})'
+            if (is_anchored):
+                anchored.append(f'(?:{source})')
+            else:
+                self.finders.append(pattern)
+        if (anchored):
+            try:
+                self.finders.append(re.compile(
+                    f'\n(?:(?:{self.prefix.pattern})|)'
+                    f'(?:{"|".join(anchored)})'))
+            except re.error:
+                self.finders = False
+
+    def match(self, message):
+        for pattern, action in self.patterns:
+            m = pattern.search(message)
+            if (m):
+                return (action, m)
+        return (None, None)
+
+    # Returns the offsets of the lines of text to match, in order
+    def candidate_lines(self, text):
+        if (self.finders is None):
+            self.compile()
+        if (not self.finders):
+            return [0] + [m.end() for m in re.finditer('\n', text)]
+        # The first line has no newline before it and is always checked
+        starts = {0}
+        for finder in self.finders:
+            for m in finder.finditer(text):
+                # A match can run over several lines; check all of them
+                starts.add(text.rfind('\n', 0, m.start()) + 1)
+                nl = text.find('\n', m.start(), m.end())
+                while (nl >= 0):
+                    starts.add(nl + 1)
+                    nl = text.find('\n', nl + 1, m.end())
+        return sorted(starts)
+
+    #
+    # Yields (prefix match, rest of the line, action, match) for each line
+    # of text a pattern matches, in order. text is a block of whole lines.
+    #
+    def scan(self, text):
+        for start in self.candidate_lines(text):
+            if (start >= len(text)):
+                break
+            end = text.find('\n', start)
+            if (end < 0):
+                end = len(text)
+            line = text[start:end]
+            prefix = self.prefix.match(line)
+            message = line[prefix.end():] if prefix else line
+            action, m = self.match(message)
+            if (m):
+                yield (prefix, message, action, m)
+
+#
+# Yields blocks of whole lines read from f, a text file, size characters
+# at a time. The last line may have no newline.
+#
+def iter_line_blocks(f,size=LOG_CHUNK_SIZE):
+    rest = ''
+    for block in iter(lambda: f.read(size), ''):
+        block = rest + block
+        end = block.rfind('\n') + 1
+        rest = block[end:]
+        if (end):
+            yield block[:end]
+    if (rest):
+        yield rest
+
+#
+# Scanners
+#
+# A scan log plugin provides a Scanner class. A new scanner is made for
+# each log, fed the text of the log in blocks of whole lines, then
+# finish() returns the scan log, a dictionary. Scanners keep their state
+# in the object, so logs can be scanned while they stream in and several
+# at a time. Older plugins provide a function that reads the whole log
+# from a file instead; FunctionScanner adapts them, spooling the text to
+# a file as the logs are, so it is not held in memory.
+#
+class Scanner:
+    def feed(self, text):
+        raise NotImplementedError
+
+    def finish(self):
+        raise NotImplementedError
+
+class FunctionScanner(Scanner):
+    def __init__(self, func):
+        self.func = func
+        self.spool = tempfile.SpooledTemporaryFile(
+            max_size=LOG_SPOOL_SIZE, mode='w+', encoding='utf-8',
+            newline='')
+
+    def feed(self, text):
+        self.spool.write(text)
+
+    def finish(self):
+        try:
+            self.spool.seek(0)
+            return self.func(self.spool)
+        finally:
+            self.spool.close()
+
+#
+# Feeds a scanner whole lines from text split anywhere. error keeps the
+# exception of a failed feed; later text is then dropped.
+#
+class LineScanner(Scanner):
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.rest = ''
+        self.error = None
+
+    def feed(self, text):
+        if (self.error):
+            return
+        text = self.rest + text
+        end = text.rfind('\n') + 1
+        self.rest = text[end:]
+        try:
+            if (end):
+                self.scanner.feed(text[:end])
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        if (self.rest):
+            self.scanner.feed(self.rest)
+        return self.scanner.finish()
+
+#
+# Returns a factory of scanners for the class or old style function
+# name in a plugin file
+#
+def load_scanner_from_file(file_path, name):
+    obj = load_func_from_file(file_path, name)
+    if (obj is None or (isinstance(obj, type) and hasattr(obj, 'feed'))):
+        return obj
+    return lambda: FunctionScanner(obj)
+
+#
+# The scanner is fingerprinted with the hash of its plugin file so its
+# cached scan logs are dropped when the plugin changes. Its scan logs are
+# kept under scan_log_key, the plugin path and function name, so plugins
+# with functions of the same name keep apart.
+#
+scan_log_scanner = None
+scan_log_path = None
+scan_log_func_name = None
+scan_log_key = None
+scan_log_fingerprint = None
+
+def init_scan_log(path, func_name):
+    global scan_log_scanner, scan_log_path, scan_log_func_name
+    global scan_log_key, scan_log_fingerprint
+    scan_log_scanner = load_scanner_from_file(path, func_name)
+    scan_log_path = path
+    scan_log_func_name = func_name
+    scan_log_key = '%s:%s' % (os.path.realpath(path), func_name)
+    with open(path, 'rb') as f:
+        scan_log_fingerprint = hashlib.sha256(f.read()).hexdigest()
+
+def new_scanner():
+    return LineScanner(scan_log_scanner())
+
+# Yields frames, feeding their text to scanner on the way
+def feed_frames(scanners, frames):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for frame in frames:
+        text = decoder.decode(frame)
+        for scanner in scanners:
+            scanner.feed(text)
+        yield frame
+    text = decoder.decode(b'', final=True)
+    for scanner in scanners:
+        scanner.feed(text)
+
+def scan_text(texts):
+    scanner = new_scanner()
+    for text in texts:
+        scanner.feed(text)
+    if (scanner.error):
+        raise scanner.error
+    return scanner.finish()
+
 def get_scan_log(buildlog):
-    global scan_log_func
-    fin=io.StringIO(buildlog)
-    s=scan_log_func(fin)
-    return s
+    return scan_text([buildlog])
+
+def db_get_scan_log(build):
+    job_name, build_num = build
+    return scan_text(db_iter_build_log(job_name,build_num))
+
+def scan_all(build_info):
+    return True
+
+def scan_failed(build_info):
+    return build_info['result'] != "SUCCESS"
+
+#
+# Scan pool
+#
+# Scanning build logs is CPU bound. When a report covers more than one
+# build, the logs are read and scanned by scan_workers processes, and
+# the scan logs are handed back in build order to the main process,
+# which prints and emails them. Each worker loads the scan log plugin and
+# opens its own read-only connection to the DB.
+#
+scan_workers = os.cpu_count() or 1
+scan_pool = None
+
+def init_scan_worker(log_path, func_name, path, cache_kib):
+    global conn, cursor, db_read_only
+    sys.modules.setdefault('kvetch', sys.modules[__name__])
+    init_scan_log(log_path, func_name)
+    conn = sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro',
+                           uri=True)
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA cache_size=%d' % -cache_kib)
+    db_read_only = True
+
+def scan_worker(build):
+    if (build is None):
+        return None
+    return db_get_scan_log(build)
+
+def get_scan_pool():
+    global scan_pool
+    if (scan_pool is None):
+        # Spawned, not forked, as the fetch threads may be running
+        scan_pool = ProcessPoolExecutor(
+            max_workers=scan_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_scan_worker,
+            initargs=(scan_log_path, scan_log_func_name, db_path,
+                      db_cache_kib))
+    return scan_pool
+
+def close_scan_pool():
+    global scan_pool
+    if (scan_pool):
+        scan_pool.shutdown(cancel_futures=True)
+        scan_pool = None
+
+#
+# Yields ((job_info, build_info), scan log) for each of builds, in order.
+# The scan log is None for builds scan_pred rejects. Scan logs are kept
+# in scan_results, so a build is only scanned again when the scan log
+# plugin changes.
+#
+def db_scan_builds(builds, scan_pred, parallel=True):
+    cached = {}
+
+    def scan_key(build):
+        job_info, build_info = build
+        if (not scan_pred(build_info)):
+            return None
+        key = (build_info['name'], build_info['number'])
+        s = db_get_scan_result(*key, scan_log_key,
+                               scan_log_fingerprint)
+        if (s is not None):
+            cached[key] = s
+            return None
+        # Legacy logs are converted and committed here, workers only
+        # read and only see committed rows
+        db_build_log_exists(db_job_id(key[0]), key[1])
+        if (pooled and conn.in_transaction):
+            commit_sqlite()
+        return key
+
+    pooled = scan_workers > 1 and parallel and db_path != ":memory:"
+    if (not pooled):
+        results = ((build, scan_worker(scan_key(build))) for build in builds)
+    else:
+        # Workers only see committed rows
+        commit_sqlite()
+        results = map_ordered(get_scan_pool(), 2*scan_workers, scan_worker,
+                              builds, key=scan_key)
+
+    for build, s in results:
+        key = (build[1]['name'], build[1]['number'])
+        if (s is None):
+            s = cached.pop(key, None)
+        else:
+            db_set_scan_result(*key, scan_log_key,
+                               scan_log_fingerprint, s)
+        if (s is not None):
+            db_add_failure(build[1], s)
+        yield (build, s)
+
+#
+# Log search
+#
+# Lines of the build logs that match log_search_pattern are indexed in
+# the log_search FTS5 table as the logs are recorded, so -g finds them
+# across the whole history without reading any log. With the trigram
+# tokenizer any substring of 3 or more characters can be searched for,
+# older SQLite builds fall back to searching for words. An empty
+# log_search_pattern indexes every line. Logs stored before the index
+# existed, or recorded with search_on_sync off, are indexed the first time
+# their jobs are searched.
+#
+LOG_SEARCH_LINE_MAX = 1000
+log_search_pattern = (r"error|fail|fatal|exception|traceback|abort|"
+                      r"timed? ?out|denied|refused|killed|not found|"
+                      r"cannot|unable to|\*\*\*")
+log_search_regex = re.compile(log_search_pattern,
+                              re.IGNORECASE | re.MULTILINE)
+log_search_enabled = False
+log_search_trigram = False
+search_limit = 100
+
+def init_log_search(pattern):
+    global log_search_pattern, log_search_regex
+    log_search_pattern = pattern
+    log_search_regex = None
+    if (pattern):
+        log_search_regex = re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+
+def db_create_log_search():
+    global log_search_enabled, log_search_trigram
+    log_search_enabled = False
+    for tokenize in ('trigram', 'unicode61'):
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS log_search USING fts5 (
+                    text,
+                    job_id UNINDEXED,
+                    number UNINDEXED,
+                    line UNINDEXED,
+                    tokenize = '{tokenize}'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            continue
+        log_search_enabled = True
+        break
+    if (log_search_enabled):
+        cursor.execute('''
+            SELECT sql FROM sqlite_master WHERE name = 'log_search'
+        ''')
+        log_search_trigram = 'trigram' in cursor.fetchone()[0]
+
+#
+# Fed whole lines by a LineScanner, line numbers start at 1
+#
+class LogSearchIndexer(Scanner):
+    def __init__(self, job_id, build_num):
+        self.job_id = job_id
+        self.number = build_num
+        self.line = 1
+
+    def add(self, line, text):
+        db_write('''
+            INSERT INTO log_search (text, job_id, number, line)
+            VALUES (?, ?, ?, ?)
+        ''', (text.rstrip('\r')[:LOG_SEARCH_LINE_MAX],
+              self.job_id, self.number, line))
+
+    def feed(self, text):
+        if (log_search_regex is None):
+            lines = text.split('\n')
+            for i, line in enumerate(lines):
+                if (line.strip()):
+                    self.add(self.line + i, line)
+            self.line += len(lines) - 1
+            return
+
+        pos = 0
+        end = -1
+        for m in log_search_regex.finditer(text):
+            if (m.start() <= end):
+                continue
+            start = text.rfind('\n', 0, m.start()) + 1
+            self.line += text.count('\n', pos, start)
+            pos = start
+            end = text.find('\n', m.start())
+            if (end < 0):
+                end = len(text)
+            self.add(self.line, text[start:end])
+        self.line += text.count('\n', pos)
+
+    def finish(self):
+        db_write('''
+            INSERT OR IGNORE INTO log_search_builds (job_id, number)
+            VALUES (?, ?)
+        ''', (self.job_id, self.number))
+
+search_on_sync = True
+def new_log_search_indexer(job_name, build_num):
+    if (not log_search_enabled):
+        return None
+    job_id = db_job_id(job_name,create=True)
+    return LineScanner(LogSearchIndexer(job_id, build_num))
+
+#
+# Indexes the stored logs of the jobs (all jobs if job_ids is None) that
+# are not in log_search yet
+#
+def db_index_build_logs(job_ids=None):
+    db_flush()
+    sql = '''
+        SELECT j.name, l.job_id, l.number
+        FROM logfiles l JOIN jobs j ON j.id = l.job_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM log_search_builds s
+            WHERE s.job_id = l.job_id AND s.number = l.number)
+    '''
+    order = ' ORDER BY l.number, l.job_id'
+    params = []
+    if (job_ids is not None):
+        sql += ' AND l.job_id IN (%s)' % ','.join('?'*len(job_ids))
+        params = job_ids
+    builds = conn.execute(sql + order, params).fetchall()
+    if (not builds):
+        return
+    print("Indexing %d build logs for search ..." % len(builds))
+    for name, job_id, number in builds:
+        indexer = LineScanner(LogSearchIndexer(job_id, number))
+        for text in db_iter_build_log(name, number):
+            indexer.feed(text)
+        indexer.finish()
+        db_build_written()
+    commit_sqlite()
+
+#
+# Yields (job name, build number, line number, line) of the indexed lines
+# containing query, the last indexed first. Following the rowids lets a
+# limited search stop early however many lines match.
+#
+def db_search_logs(job_infos, query, limit=None):
+    job_ids = None
+    if (job_infos):
+        job_ids = [ i for i in (db_job_id(ji['name']) for ji in job_infos)
+                    if i is not None ]
+    db_index_build_logs(job_ids)
+
+    sql = '''
+        SELECT j.name, s.number, s.line, s.text
+        FROM log_search s JOIN jobs j ON j.id = s.job_id
+        WHERE log_search MATCH ?
+    '''
+    params = ['"%s"' % query.replace('"', '""')]
+    if (job_ids is not None):
+        sql += ' AND s.job_id IN (%s)' % ','.join('?'*len(job_ids))
+        params += job_ids
+    sql += ' ORDER BY s.rowid DESC'
+    if (limit is not None):
+        sql += ' LIMIT ?'
+        params.append(limit)
+    yield from conn.execute(sql, params)
+
+def print_search_logs(f, job_infos, query):
+    hits = 0
+    for name, number, line, text in db_search_logs(job_infos, query,
+                                                   search_limit + 1):
+        hits += 1
+        if (hits > search_limit):
+            print("... showing the first %d matches" % search_limit, file=f)
+            break
+        print("%-40s #%-4d %6d: %s" % (name, number, line, text), file=f)
+
+#
+# Failure signatures
+#
+# The scan log of a failed build is normalized, dropping the timestamps,
+# paths, hashes and numbers that differ between occurrences of the same
+# failure, and hashed into its signature. failures keeps when each
+# signature was first and last seen and how often, failure_builds the
+# builds with it, so repeated failures are found with indexed lookups
+# instead of comparing scan logs. Scan log plugins can return the text
+# that identifies the failure as 'signature', otherwise the summary is
+# used.
+#
+FAILURE_NOISE = [
+    (re.compile(r"\d{4}-\d\d-\d\d[T ]\d\d:\d\d(:\d\d)?([.,]\d+)?"
+                r"(Z|[+-]\d\d:?\d\d)?"), "<time>"),
+    (re.compile(r"\b\d\d?:\d\d:\d\d([.,]\d+)?\b"), "<time>"),
+    (re.compile(r"([A-Za-z]:)?([\\/][\w.@+~-]+)+[\\/]?"), "<path>"),
+    (re.compile(r"\b0x[0-9a-fA-F]+\b|\b(?=\d*[a-f])(?=[a-f]*\d)[0-9a-f]{7,}\b"),
+     "<hex>"),
+    (re.compile(r"\d+"), "<n>"),
+    (re.compile(r"[ \t]+"), " "),
+]
+
+def normalize_failure(text):
+    for pattern, repl in FAILURE_NOISE:
+        text = pattern.sub(repl, text)
+    return '\n'.join(line.strip() for line in text.splitlines()
+                     if line.strip())
+
+#
+# Returns (signature, normalized text) of the scan log of a failed build
+# or (None, None)
+#
+def failure_signature(build_info,s):
+    if (s is None or build_info['result'] == "SUCCESS"):
+        return (None, None)
+    text = normalize_failure(s.get('signature', s.get('summary')) or '')
+    if (not text):
+        return (None, None)
+    return (hashlib.sha256(text.encode('utf-8')).digest(), text)
+
+def db_add_failure(build_info,s):
+    signature, text = failure_signature(build_info,s)
+    if (signature is None):
+        return None
+    job_id = db_job_id(build_info['name'],create=True)
+    added = conn.execute('''
+        INSERT OR IGNORE INTO failure_builds (signature, job_id, number)
+        VALUES (?, ?, ?)
+    ''', (signature,job_id,build_info['number'])).rowcount
+    if (added):
+        timestamp = build_info['timestamp']
+        db_write('''
+            INSERT INTO failures
+            (signature, firstSeen, lastSeen, count, sample)
+            VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT(signature) DO UPDATE SET
+                firstSeen = MIN(firstSeen, excluded.firstSeen),
+                lastSeen = MAX(lastSeen, excluded.lastSeen),
+                count = count + 1
+        ''', (signature,timestamp,timestamp,text))
+    return signature
+
+def db_get_build_failures(job_name,build_num):
+    job_id = db_job_id(job_name)
+    rows = conn.execute('''
+        SELECT signature FROM failure_builds
+        WHERE job_id = ? AND number = ?
+    ''', (job_id,build_num)).fetchall()
+    return [ row[0] for row in rows ]
+
+def db_get_failure(signature):
+    db_flush()
+    row = conn.execute('''
+        SELECT firstSeen, lastSeen, count, sample
+        FROM failures WHERE signature = ?
+    ''', (signature,)).fetchone()
+    if (row is None):
+        return None
+    failure = {}
+    failure['signature'] = signature
+    failure['firstSeen'] = row[0]
+    failure['lastSeen']  = row[1]
+    failure['count']     = row[2]
+    failure['sample']    = row[3]
+    failure['jobs']      = [ r[0] for r in conn.execute('''
+        SELECT DISTINCT j.name
+        FROM failure_builds f JOIN jobs j ON j.id = f.job_id
+        WHERE f.signature = ?
+        ORDER BY j.name
+    ''', (signature,)) ]
+    return failure
+
+def print_failure_history(f,build_info,s):
+    signature, text = failure_signature(build_info,s)
+    failure = db_get_failure(signature) if signature else None
+    if (failure and failure['count'] > 1):
+        print("Failure seen in %d builds of %s, first %s ago" %
+              (failure['count'], ", ".join(failure['jobs']),
+               time_elapsed_str(time_elapsed(failure['firstSeen']))),
+              file=f)
 
 scan_log_limit = 0
 def print_scan_log(f,job_info,buildlog):
+    print_scan(f,get_scan_log(buildlog))
+
+def print_scan(f,s):
     global scan_log_limit
-    s=get_scan_log(buildlog)
     if (s['summary']):
         if (scan_log_limit > 0):
             print(truncate_to_n_lines(s['summary'],scan_log_limit),file=f)
@@ -890,26 +3253,34 @@ def scan_log_callback(f,job_info,build_info):
     print_build_scan_log(f,job_info,build_info,buildlog)
 
 
-def db_scan_log_callback(f,job_info,build_info):
-    name=build_info['name']
-    num=build_info['number']
-    buildlog=db_get_build_log(name,num)
-    print_build_scan_log(f,job_info,build_info,buildlog)
+def db_scan_log_callback(f,job_info,build_info,s):
+    print_header(f,job_info,build_info)
+    print_scan(f,s)
+    print_failure_history(f,build_info,s)
 
+log_tail_lines = 0
 def db_print_log_callback(f,job_info,build_info):
     print_header(f,job_info,build_info)
 
     name=build_info['name']
     num=build_info['number']
-    buildlog=db_get_build_log(name,num)
-    print(f,buildlog)
+    if (log_tail_lines > 0):
+        buildlog=db_iter_build_log_tail(name,num,log_tail_lines)
+    else:
+        buildlog=db_iter_build_log(name,num)
+    for text in buildlog:
+        f.write(text)
 
 def skip_success(job_info,build_info):
     if (build_info['result'] == "SUCCESS"):
         return True
     return False
+db_build_filters[skip_success] = "result != 'SUCCESS'"
 
-def kvetch(f,job_info,build_info,buildlog,do_email):
+#
+# s is the scan log of the build, it is not used for successful builds
+#
+def kvetch(f,job_info,build_info,s,do_email):
     global enable_header,kvetch_mode
     global build_monitors,dev_monitors,all_monitors,debug_email
     enable_header=True
@@ -919,23 +3290,23 @@ def kvetch(f,job_info,build_info,buildlog,do_email):
 
     if (build_info['result']=='SUCCESS'):
         if (build_info['number']-1 == job_info['lastFailedBuild']):
-            kvetch_info = db_get_kvetch_info(build_info['name'])
+            kvetch_info = get_kvetch_info(build_info['name'])
             if (do_email):
                 if (not (kvetch_info and len(kvetch_info['target'])>0)):
                     return
 
                 print_header(f,job_info,build_info)
                 #TBD: add claimee even if not previously kvetched at?
-                send_email(kvetch_info['target'],
-                           None, # TBD: who else might be interested
-                           f"kvetch: {build_info['fullDisplayName']} successful again",
-                           build_info['url']+"\n", kvetch_mode)
+                target = kvetch_info['target']
                 # Clear out the kvetch_info
                 kvetch_info['build'] = -1
                 kvetch_info['target'] = ""
                 kvetch_info['timestamp'] = datetime.datetime.now().timestamp() * 1000
                 kvetch_info['level'] = 1
-                db_set_kvetch_info(kvetch_info)
+                kvetch_email(target,
+                             None, # TBD: who else might be interested
+                             f"kvetch: {build_info['fullDisplayName']} successful again",
+                             build_info['url']+"\n", kvetch_info)
             else:
                 print(f"{build_info['fullDisplayName']} successful again")
                 if (kvetch_info):
@@ -954,7 +3325,6 @@ def kvetch(f,job_info,build_info,buildlog,do_email):
     developers=get_developers(build_info)
 
     msg=io.StringIO()
-    s=get_scan_log(buildlog)
 
     if (s['blame'] == "System"):
         email_to = build_monitors
@@ -1008,7 +3378,8 @@ def kvetch(f,job_info,build_info,buildlog,do_email):
 
     body+="\nSincerely,\nKvetch\n\n"
 
-    kvetch_info = db_get_kvetch_info(build_info['name'])
+    signature, text = failure_signature(build_info,s)
+    kvetch_info = get_kvetch_info(build_info['name'])
     # Only skip kvetching if we are sending an email
     if (kvetch_info and do_email):
         if (kvetch_info['target']==email_to):
@@ -1017,8 +3388,11 @@ def kvetch(f,job_info,build_info,buildlog,do_email):
             # and twice a day for new builds
             if (kvetch_info['build']==build_info['number']):
                 tlimit=(23*(60*60))
+            elif (signature in db_get_build_failures(build_info['name'],
+                                                     kvetch_info['build'])):
+                # Same failure as last time, treat it as the same build
+                tlimit=(23*(60*60))
             else:
-                # TBD: look to see if same failure as last time
                 tlimit=(12*(60*60))
             if ((elapsedKvetchTime.days < 1) and
                 (elapsedKvetchTime.seconds < tlimit)):
@@ -1041,29 +3415,271 @@ def kvetch(f,job_info,build_info,buildlog,do_email):
     print_header(msg,job_info,build_info)
     if (s['summary']):
         print(s['summary'],file=msg)
+    print_failure_history(msg,build_info,s)
     print_changeSets(msg,build_info)
 
     subject="Kvetch:"
     subject+=" "+build_info['fullDisplayName']
     body+=msg.getvalue()
     if (do_email):
-        send_email(email_to, email_cc, subject, body, kvetch_mode)
-        db_set_kvetch_info(kvetch_info)
+        kvetch_email(email_to, email_cc, subject, body, kvetch_info)
     else:
         print(subject,file=f)
         print(body,file=f)
 
-def db_kvetch_internal_callback(f,job_info,build_info, do_email):
-    name=build_info['name']
-    num=build_info['number']
-    buildlog=db_get_build_log(name,num)
-    kvetch(f,job_info,build_info,buildlog,do_email)
+#
+# With kvetch_digest, the emails kvetch() sends in a run are collected
+# and grouped by their To and Cc, and send_kvetch_digests() sends one
+# email to each group covering all of its builds. The kvetch infos of
+# the jobs are kept pending, for the later builds of the run to see, and
+# written in one transaction once the digests are queued.
+#
+kvetch_mode = 'OFF'
+kvetch_digest = False
+kvetch_digests = {}     # (to, cc) -> [(subject, body)]
+kvetch_pending = {}     # job name -> kvetch info
+
+def get_kvetch_info(job_name):
+    kvetch_info = kvetch_pending.get(job_name)
+    if (kvetch_info is None):
+        kvetch_info = db_get_kvetch_info(job_name)
+    return kvetch_info
+
+def kvetch_email(to_email, cc_email, subject, body, kvetch_info):
+    if (not kvetch_digest):
+        send_email(to_email, cc_email, subject, body, kvetch_mode)
+        db_set_kvetch_info(kvetch_info)
+        return
+    kvetch_digests.setdefault((to_email, cc_email), []).append((subject,
+                                                                body))
+    kvetch_pending[kvetch_info['jobName']] = kvetch_info
+
+def send_kvetch_digests():
+    for (to_email, cc_email), emails in kvetch_digests.items():
+        if (len(emails) == 1):
+            subject, body = emails[0]
+        else:
+            subject = "Kvetch: %d builds" % len(emails)
+            body = "".join("  %s\n" % s for s, b in emails) + "\n"
+            for s, b in emails:
+                body += "%s\n%s\n\n%s\n" % (s, '='*len(s), b)
+        send_email(to_email, cc_email, subject, body, kvetch_mode)
+    kvetch_digests.clear()
+
+    for kvetch_info in kvetch_pending.values():
+        db_write_kvetch_info(kvetch_info)
+    kvetch_pending.clear()
+    commit_sqlite()
+
+def db_kvetch_internal_callback(f,job_info,build_info,s,do_email):
+    kvetch(f,job_info,build_info,s,do_email)
+
+def db_kvetch_print_callback(f,job_info,build_info,s):
+    db_kvetch_internal_callback(f,job_info,build_info,s,False)
+
+def db_kvetch_email_callback(f,job_info,build_info,s):
+    db_kvetch_internal_callback(f,job_info,build_info,s,True)
+
+#
+# HTTP API
+#
+# With -p, kvetch serves what it has in the DB as JSON, read only, so
+# dashboards and bots can ask kvetch instead of Jenkins:
+#
+#   /views                        jobs of the views kvetch has loaded
+#   /status?view=V&job=J          last build of each job
+#   /history?job=J&limit=N        builds of a job, newest first, below
+#                                 &before=N
+#   /scan?job=J&build=N           stored scan log of a build
+#   /claims?view=V&job=J          claims of the jobs whose last build failed
+#
+# Without a view or job, /status and /claims cover every job. Requests are
+# answered by the threads of a ThreadingHTTPServer using a pool of
+# read-only connections, and responses are cached for api_cache_seconds.
+# With -w, the cache is cleared after each sync.
+#
+api_host = '127.0.0.1'
+api_cache_seconds = 10
+API_CACHE_ENTRIES = 1000
+API_HISTORY_LIMIT = 1000
+api_conns = queue.SimpleQueue()
+api_cache = {}      # path -> (expiry, status, body)
+api_cache_lock = threading.Lock()
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def api_connect():
+    try:
+        return api_conns.get_nowait()
+    except queue.Empty:
+        db = sqlite3.connect(Path(db_path).resolve().as_uri() + '?mode=ro',
+                             uri=True, check_same_thread=False)
+        db.execute('PRAGMA cache_size=%d' % -db_cache_kib)
+        return db
+
+def api_param(params, name, required=True):
+    values = params.get(name)
+    if (not values):
+        if (required):
+            raise ApiError(400, "missing %s" % name)
+        return None
+    return values[0]
+
+def api_int_param(params, name, default=None):
+    value = api_param(params, name, default is None)
+    if (value is None):
+        return default
+    if (not value.isdigit()):
+        raise ApiError(400, "%s is not a number" % name)
+    return int(value)
+
+def api_job_names(db, params):
+    job_names = list(params.get('job', []))
+    for view_name in params.get('view', []):
+        row = db.execute('''
+            SELECT jobs FROM views WHERE name = ?
+        ''', (view_name,)).fetchone()
+        if (row is None):
+            raise ApiError(404, "unknown view %s" % view_name)
+        job_names.extend(json.loads(row[0]))
+    if ('job' not in params and 'view' not in params):
+        job_names = [ row[0] for row in
+                      db.execute('SELECT name FROM jobs ORDER BY name') ]
+    return job_names
+
+def api_job_id(db, job_name):
+    row = db.execute('SELECT id FROM jobs WHERE name = ?',
+                     (job_name,)).fetchone()
+    if (row is None):
+        raise ApiError(404, "unknown job %s" % job_name)
+    return row[0]
 
-def db_kvetch_print_callback(f,job_info,build_info):
-    db_kvetch_internal_callback(f,job_info,build_info,False)
+def api_last_build(db, job_name):
+    row = db.execute(f'''
+        SELECT {BUILD_COLUMNS}
+        FROM builds
+        WHERE job_id = (SELECT id FROM jobs WHERE name = ?)
+        ORDER BY number DESC LIMIT 1
+    ''', (job_name,)).fetchone()
+    return db_make_build_info(job_name,row) if row else None
+
+def api_views(db, params):
+    return { name: json.loads(jobs) for name, jobs in
+             db.execute('SELECT name, jobs FROM views ORDER BY name') }
+
+def api_status(db, params):
+    jobs = []
+    for job_name in api_job_names(db, params):
+        row = db.execute('''
+            SELECT MAX(number) FROM builds
+            WHERE job_id = (SELECT id FROM jobs WHERE name = ?)
+                  AND result = 'SUCCESS'
+        ''', (job_name,)).fetchone()
+        jobs.append({ 'name': job_name,
+                      'lastSuccessfulBuild': row[0],
+                      'lastBuild': api_last_build(db, job_name) })
+    return jobs
 
-def db_kvetch_email_callback(f,job_info,build_info):
-    db_kvetch_internal_callback(f,job_info,build_info,True)
+def api_history(db, params):
+    job_name = api_param(params, 'job')
+    job_id = api_job_id(db, job_name)
+    limit = min(api_int_param(params, 'limit', 50), API_HISTORY_LIMIT)
+    before = api_int_param(params, 'before', -1)
+    rows = db.execute(f'''
+        SELECT {BUILD_COLUMNS}
+        FROM builds
+        WHERE job_id = ? AND (? < 0 OR number < ?)
+        ORDER BY number DESC LIMIT ?
+    ''', (job_id,before,before,limit))
+    return [ db_make_build_info(job_name,row) for row in rows ]
+
+def api_scan(db, params):
+    job_name = api_param(params, 'job')
+    build_num = api_int_param(params, 'build')
+    row = db.execute('''
+        SELECT result FROM scan_results
+        WHERE job_id = ? AND number = ? AND scanner = ? AND fingerprint = ?
+    ''', (api_job_id(db, job_name),build_num,scan_log_key,
+          scan_log_fingerprint)).fetchone()
+    if (row is None):
+        raise ApiError(404, "%s #%d has not been scanned"
+                       % (job_name,build_num))
+    return json.loads(row[0])
+
+def api_claims(db, params):
+    claims = []
+    for job_name in api_job_names(db, params):
+        build_info = api_last_build(db, job_name)
+        if (build_info and build_info['result'] != 'SUCCESS'):
+            claims.append({ 'name': job_name,
+                            'number': build_info['number'],
+                            'result': build_info['result'],
+                            'url': build_info['url'],
+                            'claims': build_info['claims'] })
+    return claims
+
+API_ROUTES = {
+    '/views': api_views,
+    '/status': api_status,
+    '/history': api_history,
+    '/scan': api_scan,
+    '/claims': api_claims,
+}
+
+def api_get(path):
+    now = time.monotonic()
+    with api_cache_lock:
+        cached = api_cache.get(path)
+        if (cached and cached[0] > now):
+            return cached[1:]
+
+    url = urlparse(path)
+    route = API_ROUTES.get(url.path.rstrip('/'))
+    db = api_connect()
+    try:
+        if (route is None):
+            raise ApiError(404, "unknown path %s" % url.path)
+        status, result = 200, route(db, parse_qs(url.query))
+    except ApiError as e:
+        status, result = e.status, { 'error': str(e) }
+    except sqlite3.Error as e:
+        status, result = 500, { 'error': str(e) }
+    finally:
+        api_conns.put(db)
+    body = json.dumps(result).encode('utf-8')
+
+    with api_cache_lock:
+        if (len(api_cache) >= API_CACHE_ENTRIES):
+            for key in [ k for k, c in api_cache.items() if c[0] <= now ]:
+                del api_cache[key]
+        if (len(api_cache) < API_CACHE_ENTRIES):
+            api_cache[path] = (now + api_cache_seconds, status, body)
+    return (status, body)
+
+def clear_api_cache():
+    with api_cache_lock:
+        api_cache.clear()
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, body = api_get(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'max-age=%d' % api_cache_seconds)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_api_server(port):
+    return ThreadingHTTPServer((api_host, port), ApiHandler)
 
 #
 # Main Program
@@ -1072,7 +3688,7 @@ def db_kvetch_email_callback(f,job_info,build_info):
 if __name__ == "__main__":
     import getopt
 
-    opts,args = getopt.getopt(sys.argv[1:], 'b:c:j:v:adfklmnqrsx')
+    opts,args = getopt.getopt(sys.argv[1:], 'b:c:g:j:p:t:v:w:adfklmnqrsx')
 
     if len(args) > 0:
         print("Usage: %s" % sys.argv[0])
@@ -1103,7 +3719,7 @@ if __name__ == "__main__":
     jenkins_auth=config['jenkins_auth']
     db_path=config['db_path']
     scanlogpath=find_config_file(config['scanlogpy'])
-    scan_log_func=load_func_from_file(scanlogpath,config['scanlogfunc'])
+    init_scan_log(scanlogpath,config['scanlogfunc'])
 
     org_path=config['org_chart']
     org_path=find_config_file(org_path)
@@ -1111,6 +3727,8 @@ if __name__ == "__main__":
     from_email=config['from_email']
     smtp_server=config['smtp_server']
     smtp_port=config['smtp_port']
+    mail_retries=config.get('mail_retries',mail_retries)
+    mail_retry_delay=config.get('mail_retry_delay',mail_retry_delay)
     build_monitors_list=config['build_monitors']
     build_monitors=",".join(build_monitors_list)
     dev_monitors_list=config['dev_monitors']
@@ -1119,114 +3737,248 @@ if __name__ == "__main__":
     debug_email=config['debug_email']
     kvetch_mode=config['kvetch_mode']
     report_mode=config['report_mode']
+    kvetch_digest=config.get('kvetch_digest',kvetch_digest)
+    api_host=config.get('api_host',api_host)
+    api_cache_seconds=config.get('api_cache_seconds',api_cache_seconds)
+    fetch_workers=config.get('fetch_workers',fetch_workers)
+    fetch_host_limit=config.get('fetch_host_limit',fetch_host_limit)
+    jenkins_timeout=config.get('jenkins_timeout',jenkins_timeout)
+    jenkins_rate=config.get('jenkins_rate',jenkins_rate)
+    jenkins_burst=config.get('jenkins_burst',jenkins_burst)
+    jenkins_retries=config.get('jenkins_retries',jenkins_retries)
+    jenkins_retry_delay=config.get('jenkins_retry_delay',jenkins_retry_delay)
+    jenkins_slow_seconds=config.get('jenkins_slow_seconds',
+                                    jenkins_slow_seconds)
+    jenkins_breaker_failures=config.get('jenkins_breaker_failures',
+                                        jenkins_breaker_failures)
+    jenkins_breaker_seconds=config.get('jenkins_breaker_seconds',
+                                       jenkins_breaker_seconds)
+    scan_workers=config.get('scan_workers',scan_workers)
+    scan_on_sync=config.get('scan_on_sync',scan_on_sync)
+    init_log_search(config.get('search_pattern',log_search_pattern))
+    search_limit=config.get('search_limit',search_limit)
+    search_on_sync=config.get('search_on_sync',search_on_sync)
+    db_commit_builds=config.get('db_commit_builds',db_commit_builds)
+    db_commit_seconds=config.get('db_commit_seconds',db_commit_seconds)
+    db_cache_kib=config.get('db_cache_kib',db_cache_kib)
+    http_cache=config.get('http_cache',http_cache)
+    http_cache_ttls.update(config.get('http_cache_ttls',{}))
+    log_codec=config.get('log_codec',log_codec)
+    if (log_codec == 'zstd' and zstandard is None):
+        print("Error: log_codec zstd needs the zstandard package")
+        sys.exit(1)
+    jenkins_backend=config.get('jenkins_backend',jenkins_backend)
+    jenkins_async_limit=config.get('jenkins_async_limit',jenkins_async_limit)
+    if (jenkins_backend == 'aiohttp' and aiohttp is None):
+        print("Error: jenkins_backend aiohttp needs the aiohttp package")
+        sys.exit(1)
 
-    init(org_path)
-
-    if (view_names):
-        for view_name in view_names:
-            try:
-                jobs_from_view = get_jobs(view_name)
-            except Exception as e:
-                print("Error: unable to load view: %s" % e)
-                sys.exit(1)
-            job_names.extend(get_jobs(view_name))
+    watch_interval=None
+    if '-w' in opts:
+        watch_interval=float(opts['-w'])
+        if ('-s' in opts or '-a' in opts or '-q' in opts):
+            print("Error: -w only repeats syncing and reports from the DB")
+            sys.exit(1)
 
-    try:
-        job_infos = get_job_infos(job_names,build_ids)
-    except Exception as e:
-        print("Error: unable to load jobs: %s" % e)
-        sys.exit(1)
+    init(org_path)
 
-    if (count_builds(job_infos) > 1):
-        enable_header = True
-        scan_log_limit = 30
+    # Long running kvetch stops on a kill as on ^C, finishing its work
+    if ('-p' in opts or watch_interval):
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
 
-    build_filter=None
-    if '-f' in opts:
-        build_filter=skip_success
+    #
+    # With -p the DB is served over HTTP, alone or while -w keeps it synced
+    #
+    if '-p' in opts:
+        api_server=make_api_server(int(opts['-p']))
+        print("Serving the DB on http://%s:%d/" % api_server.server_address)
+        if (not watch_interval):
+            try:
+                api_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            api_server.server_close()
+            finish()
+            sys.exit(0)
+        threading.Thread(target=api_server.serve_forever,
+                         name="kvetch-api",daemon=True).start()
 
     #
-    # These options only pull data from Jenkins
+    # Status only needs the state of the last builds, which is fetched
+    # without loading build histories
     #
     if '-s' in opts:
         if (len(build_ids)>0):
             print("ERROR: build ids not compatible with status")
             sys.exit(1)
-        print_jobs_status(sys.stdout,job_infos)
-        sys.exit(0)
-    elif '-a' in opts:
-        for_each_build(job_infos, build_filter, print_build_json,sys.stdout)
+        try:
+            job_infos, build_infos = get_jobs_status(view_names,job_names)
+        except Exception as e:
+            print("Error: unable to load status: %s" % e)
+            sys.exit(1)
+        print_jobs_status(sys.stdout,job_infos,build_infos)
         sys.exit(0)
-    elif '-q' in opts:
-        if '-d' in opts:
-            for_each_build(job_infos, build_filter, print_build,sys.stdout)
-            sys.exit(0)
-        elif '-r' in opts:
-            for_each_build(job_infos, build_filter, print_build_summary,sys.stdout)
-            sys.exit(0)
-        elif '-x' in opts:
-            # This is for triage at end of Job in Jenkins, no DB involved
-            for_each_build(job_infos, build_filter, scan_log_callback,sys.stdout)
-            sys.exit(0)
 
     #
-    # Populate new data into DB from Jenkins unless specifically suspended
+    # With -w the jobs are loaded, synced and reported on every cycle
     #
-    if (not '-n' in opts):
-        #
-        # Regardless of the builds selected by the user, we want to populate
-        # all build history.
-        #
-        pjob_infos = get_job_infos(job_names,[])
-
-        if (for_each_build(pjob_infos, skip_build, record_build,sys.stdout)):
-            print('')
-            commit_sqlite()
+    given_job_names=job_names
+    next_cycle=time.monotonic()
+    # A ^C or kill stops watching, even during a cycle, and the work
+    # done so far is still committed, mailed and closed
+    try:
+        while True:
+            if (watch_interval):
+                time.sleep(max(0, next_cycle - time.monotonic()))
+                next_cycle = time.monotonic() + watch_interval
+                cycle_start = time.monotonic()
+                job_info_cache.clear()
+                first_record = True
+                first_header = True
+
+            job_names=list(given_job_names)
+            try:
+                for view_name in view_names:
+                    view_jobs = get_jobs(view_name)
+                    db_set_view_jobs(view_name,view_jobs)
+                    job_names.extend(view_jobs)
+            except Exception as e:
+                print("Error: unable to load view: %s" % e)
+                if (not watch_interval):
+                    sys.exit(1)
+                continue
 
-    #
-    # These options only pull data from the DB
-    #
-    out=sys.stdout
-    if '-m' in opts:
-        out = io.StringIO()
-        
+            try:
+                job_infos = get_job_infos(job_names,build_ids)
+            except Exception as e:
+                print("Error: unable to load jobs: %s" % e)
+                if (not watch_interval):
+                    sys.exit(1)
+                continue
+
+            if (count_builds(job_infos) > 1):
+                enable_header = True
+                scan_log_limit = 30
+
+            if '-t' in opts:
+                log_tail_lines = int(opts['-t'])
+
+            build_filter=None
+            if '-f' in opts:
+                build_filter=skip_success
+
+            #
+            # These options only pull data from Jenkins
+            #
+            if '-a' in opts:
+                for_each_build(job_infos, build_filter, print_build_json,sys.stdout)
+                sys.exit(0)
+            elif '-q' in opts:
+                if '-d' in opts:
+                    for_each_build(job_infos, build_filter, print_build,sys.stdout)
+                    sys.exit(0)
+                elif '-r' in opts:
+                    for_each_build(job_infos, build_filter, print_build_summary,sys.stdout)
+                    sys.exit(0)
+                elif '-x' in opts:
+                    # This is for triage at end of Job in Jenkins, no DB involved
+                    for_each_build(job_infos, build_filter, scan_log_callback,sys.stdout)
+                    sys.exit(0)
+
+            #
+            # Populate new data into DB from Jenkins unless specifically suspended
+            #
+            synced_jobs=0
+            if (not '-n' in opts):
+                #
+                # Regardless of the builds selected by the user, we want to populate
+                # all build history.
+                #
+                pjob_infos = get_job_infos(job_names,[])
+                if (watch_interval):
+                    pjob_infos = changed_jobs(pjob_infos)
+
+                try:
+                    recorded, synced = sync_builds(pjob_infos,sys.stdout)
+                    if (recorded):
+                        print('')
+                    watch_synced(synced)
+                    synced_jobs = len(synced)
+                except Exception as e:
+                    if (not watch_interval):
+                        raise
+                    print("Error: unable to sync: %s" % e)
+                commit_sqlite()
+
+            #
+            # These options only pull data from the DB
+            #
+            out=sys.stdout
+            if '-m' in opts:
+                out = io.StringIO()
+
+
+            whatis=None
+            if '-d' in opts:
+                whatis="status"
+                db_for_each_build(job_infos,build_filter,print_build,out)
+            elif '-r' in opts:
+                whatis="summary"
+                db_for_each_build(job_infos,build_filter,print_build_summary,out)
+            elif '-x' in opts:
+                whatis="scan log"
+                db_for_each_build(job_infos,build_filter,db_scan_log_callback,out,
+                                  scan_all)
+            elif '-l' in opts:
+                whatis="build log"
+                db_for_each_build(job_infos,build_filter,db_print_log_callback,out)
+            elif '-g' in opts:
+                query=opts['-g']
+                if (not log_search_enabled):
+                    print("Error: searching needs SQLite with FTS5")
+                    sys.exit(1)
+                if (log_search_trigram and len(query) < 3):
+                    print("Error: search for at least 3 characters")
+                    sys.exit(1)
+                whatis="search"
+                print_search_logs(out,job_infos,query)
+            elif '-k' in opts:
+                callback=db_kvetch_print_callback
+                if '-m' in opts:
+                    callback=db_kvetch_email_callback
+                db_for_each_build(job_infos,build_filter,callback,sys.stdout,
+                                  scan_failed)
+                send_kvetch_digests()
+
+
+            if (whatis):
+                if '-m' in opts:
+                    subject="Kvetch:"
+                    if (view_names):
+                        subject+="|".join(view_names)
+                    else:
+                        subject+="|".join(job_names)
 
-    whatis=None
-    if '-d' in opts:
-        whatis="status"
-        db_for_each_build(job_infos,build_filter,print_build,out)
-    elif '-r' in opts:
-        whatis="summary"
-        db_for_each_build(job_infos,build_filter,print_build_summary,out)
-    elif '-x' in opts:
-        whatis="scan log"
-        db_for_each_build(job_infos,build_filter,db_scan_log_callback,out)
-    elif '-l' in opts:
-        whatis="build log"
-        db_for_each_build(job_infos,build_filter,db_print_log_callback,out)
-    elif '-k' in opts:
-        callback=db_kvetch_print_callback
-        if '-m' in opts:
-            callback=db_kvetch_email_callback
-        db_for_each_build(job_infos,build_filter,callback,sys.stdout)
-
-
-    if (whatis):
-        if '-m' in opts:
-            subject="Kvetch:"
-            if (view_names):
-                subject+="|".join(view_names)
-            else:
-                subject+="|".join(job_names)
+                    subject+=" "+whatis
+                    body = out.getvalue()
+                    if (body == ""):
+                        body = "All builds were successful"
 
-            subject+=" "+whatis
-            body = out.getvalue()
-            if (body == ""):
-                body = "All builds were successful"
+                    send_email(all_monitors, None, subject, body, report_mode)
 
-            send_email(all_monitors, None, subject, body, report_mode)
-        
-    finish()
+            if (not watch_interval):
+                break
+            commit_sqlite()
+            clear_api_cache()
+            release_mail_session()
+            print("Synced %d of %d jobs in %.1fs" %
+                  (synced_jobs, len(job_names), time.monotonic() - cycle_start))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        if (not watch_interval):
+            raise
+    finally:
+        finish()
     sys.exit(0)
 
 #
@@ -1234,7 +3986,116 @@ if __name__ == "__main__":
 #
 import unittest
 
+class FakeResponse:
+    def __init__(self,body,status_code=200,headers={}):
+        self.content=body
+        self.status_code=status_code
+        self.headers=headers
+    def iter_content(self,size):
+        yield self.content
+    def close(self):
+        pass
+
+class FakeJenkins:
+    """
+    Serves the build JSON and console logs of one job, from builds, a
+    dict of build number to build JSON fields, and keeps the path of
+    each request made. A build whose fields are None fails to fetch.
+    """
+    server='https://jenkins/'
+    def __init__(self,builds):
+        self.builds=builds
+        self.requested=[]
+    def jenkins_request(self,req,stream=None):
+        path=urlparse(req.url).path
+        self.requested.append(path)
+        num=int(path.split('/')[5])
+        if (path.endswith('/progressiveText')):
+            return FakeResponse(b"log of #%d\n" % num)
+        if (self.builds[num] is None):
+            raise jenkins.JenkinsException('Error in request [500]')
+        build=dict({'number':num,'inProgress':False,'result':'SUCCESS',
+                    'fullDisplayName':'TC » a #%d' % num,
+                    'description':None,'duration':1,'timestamp':num,
+                    'url':'u','changeSets':[],'actions':[]},
+                   **self.builds[num])
+        return FakeResponse(json.dumps(build).encode())
+
 class MyTestCase(unittest.TestCase):
+    def sync(self,fake):
+        global server
+        saved=server
+        server=fake
+        fake.requested.clear()
+        job_info={'name':'TC/a','builds':sorted(fake.builds,reverse=True)}
+        for field in JOB_POINTERS:
+            job_info[field]=max(fake.builds)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.synced=sync_builds([job_info],io.StringIO())[1]
+        finally:
+            server=saved
+        return [ int(p.split('/')[5]) for p in fake.requested
+                 if p.endswith('/api/json') ]
+
+    def test_sync_new_builds(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        fake=FakeJenkins({1:{},2:{'result':'FAILURE'}})
+        self.assertEqual([2,1],self.sync(fake))
+        fake.builds[3]={}
+        self.assertEqual([3],self.sync(fake))
+        self.assertEqual(3,db_get_sync_info('TC/a')['watermark'])
+        self.assertEqual("log of #3\n",db_get_build_log('TC/a',3))
+        close_sqlite()
+
+    def test_sync_running_build(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        fake=FakeJenkins({1:{},2:{'inProgress':True,'result':None}})
+        self.assertEqual([2,1],self.sync(fake))
+        self.assertEqual([2],db_get_sync_info('TC/a')['running'])
+        self.assertFalse(db_build_num_exists('TC/a',2))
+
+        # Still below the watermark, but fetched again as it was running
+        fake.builds[2]={'result':'FAILURE'}
+        self.assertEqual([2],self.sync(fake))
+        self.assertEqual([],db_get_sync_info('TC/a')['running'])
+        self.assertEqual('FAILURE',db_get_build_info('TC/a',2)['result'])
+        close_sqlite()
+
+    def test_sync_steady_state(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        fake=FakeJenkins({1:{},2:{},3:{}})
+        self.sync(fake)
+        self.assertEqual([],self.sync(fake))
+        self.assertEqual([],fake.requested)
+        close_sqlite()
+
+    def test_sync_failed_job(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        fake=FakeJenkins({1:{},2:None})
+        self.sync(fake)
+        self.assertEqual([],self.synced)
+
+        # Watch mode retries the job while its last builds stay the same
+        job_info={'name':'TC/a','builds':[2,1]}
+        for field in JOB_POINTERS:
+            job_info[field]=2
+        watch_synced(self.synced)
+        self.assertEqual([job_info],changed_jobs([job_info]))
+        fake.builds[2]={}
+        self.assertEqual([2,1],self.sync(fake))
+        self.assertEqual(['TC/a'],[j['name'] for j in self.synced])
+        watch_last_builds.clear()
+        close_sqlite()
+
     def test_org(self):
         init_org("examples/org.json")
         self.assertEqual('waltc',get_lead_of("garyv"))
@@ -1243,3 +4104,745 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual('judyw',m[1])
         self.assertEqual('prem',m[2])
         self.assertEqual(3,len(m))
+
+    def test_projection_paths(self):
+        self.assertEqual('job/TC/job/kvetch%20main/',job_path("TC/kvetch main"))
+        job={'name':'kvetch-main.linux64',
+             'url':'https://jenkins/job/TC/job/kvetch-main.linux64/'}
+        self.assertEqual('TC/kvetch-main.linux64',get_view_job_name(job))
+        job['fullName']='TC/sub/kvetch-main.linux64'
+        self.assertEqual('TC/sub/kvetch-main.linux64',get_view_job_name(job))
+
+    def test_pattern_set(self):
+        patterns=PatternSet([(r"^ERROR: ignored", 'ignore'),
+                             (r": \*\*\*", 'make'),
+                             (r"^ERROR: (.*)", 'error')],
+                            r"(\[\d+\])?\s*")
+        text=("[1] ERROR: ignored\nok\n[2] ERROR: bad\n"
+              "make: *** ERROR: x\n  ERROR: last")
+        hits=[ (prefix.group(1),message,action)
+               for prefix, message, action, m in patterns.scan(text) ]
+        self.assertEqual([('[1]','ERROR: ignored','ignore'),
+                          ('[2]','ERROR: bad','error'),
+                          (None,'make: *** ERROR: x','make'),
+                          (None,'ERROR: last','error')],hits)
+        self.assertEqual('bad',patterns.match("ERROR: bad")[1].group(1))
+
+        # Lines without the prefix are matched too
+        patterns=PatternSet([(r"^ERROR", 'error')],r"\[\d+\] ")
+        text="[1] ok\nERROR: boom\n[2] ok\n[3] ERROR: x\n"
+        self.assertEqual([(None,'ERROR: boom'),('[3] ','ERROR: x')],
+                         [ (prefix and prefix.group(0),message)
+                           for prefix, message, action, m
+                           in patterns.scan(text) ])
+
+    def test_scanner_adapter(self):
+        log=("[2025-01-02T03:04:05.000Z] git clone x\n"
+             "fatal: early\n"
+             "make -f all.mk all\n"
+             "[2025-01-02T03:04:06.000Z] x.c:1:2: error: boom\n"
+             "ERROR: Skipping something permanently disabled\n"
+             "make: *** [all] Error 2\n"
+             "Testing initiated\n"
+             "ERROR: test_x failed\n"
+             "Testing complete\n"
+             "ssh: connection closed")
+        scanner_class=load_scanner_from_file("examples/scanlog.py","ScanLog")
+        scan_func=load_scanner_from_file("examples/scanlog.py","scan_log")
+        self.assertIsInstance(scan_func(),FunctionScanner)
+        # What the function-only scanlog.py returned for the log; the
+        # port also returns a signature
+        def scanned(s):
+            return {'count':s['count'],'summary':s['summary']}
+        expected={'count':10,
+                  'summary':"CheckOut\n--------\n"
+                            "[ERROR] fatal: early\n\n"
+                            "Build\n-----\n"
+                            "[ERROR] x.c:1:2: error: boom\n"
+                            "[ERROR] make: *** [all] Error 2\n\n"
+                            "Test\n----\n"
+                            "[ERROR] ERROR: test_x failed\n\n"
+                            "Epilogue\n--------\n"
+                            "[ERROR] ssh: connection closed\n\n"}
+        self.assertEqual(expected,scanned(load_func_from_file(
+            "examples/scanlog.py","scan_log")(io.StringIO(log))))
+        for size in (1,7,len(log)):
+            for factory in (scanner_class,scan_func):
+                scanner=LineScanner(factory())
+                for i in range(0,len(log),size):
+                    scanner.feed(log[i:i+size])
+                self.assertEqual(expected,scanned(scanner.finish()))
+
+        # The text for the function is spooled to disk, not kept in memory
+        global LOG_SPOOL_SIZE
+        spool_size, LOG_SPOOL_SIZE = LOG_SPOOL_SIZE, 64
+        try:
+            scanner=scan_func()
+            scanner.feed(log)
+            self.assertTrue(scanner.spool._rolled)
+            self.assertEqual(expected,scanned(scanner.finish()))
+        finally:
+            LOG_SPOOL_SIZE = spool_size
+
+    def test_build_log_chunks(self):
+        global db_path, LOG_CHUNK_SIZE
+        db_path=":memory:"
+        init_sqlite()
+        chunk_size, LOG_CHUNK_SIZE = LOG_CHUNK_SIZE, 7
+        log="Building » TC\n"*5
+        db_add_build_log("TC/kvetch",1,io.BytesIO(log.encode('utf-8')))
+        self.assertEqual(log,db_get_build_log("TC/kvetch",1))
+        self.assertEqual("Building » TC\n"*2,
+                         ''.join(db_iter_build_log("TC/kvetch",1,2,4)))
+        self.assertEqual("Building » TC\n"*3,
+                         ''.join(db_iter_build_log_tail("TC/kvetch",1,3)))
+
+        # Identical frames are only stored once
+        chunk_count = cursor.execute('SELECT COUNT(*) FROM chunks').fetchone()
+        db_add_build_log("TC/kvetch",3,io.BytesIO(log.encode('utf-8')))
+        self.assertEqual(chunk_count,
+                         cursor.execute('SELECT COUNT(*) FROM chunks').fetchone())
+        self.assertEqual(log,db_get_build_log("TC/kvetch",3))
+
+        # Logs stored as a single blob are converted to frames when read
+        cursor.execute('INSERT INTO logfiles VALUES (?,?,?)',
+                       (db_job_id("TC/kvetch"),2,
+                        zlib.compress(b"one\ntwo\nthree")))
+        self.assertEqual("two\nthree",
+                         ''.join(db_iter_build_log_tail("TC/kvetch",2,2)))
+        self.assertEqual("one\ntwo\nthree",db_get_build_log("TC/kvetch",2))
+        LOG_CHUNK_SIZE = chunk_size
+        close_sqlite()
+
+    def test_db_build_transaction(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        # Queued writes run in the order they were made
+        sync_info={'jobName':'TC/kvetch','watermark':1,'running':[]}
+        db_set_sync_info(sync_info)
+        db_write('DELETE FROM sync WHERE job_id = ?',
+                 (db_job_id('TC/kvetch'),))
+        db_set_sync_info(dict(sync_info,watermark=2))
+        self.assertEqual(2,db_get_sync_info('TC/kvetch')['watermark'])
+        commit_sqlite()
+
+        # A build whose log fails is not kept, not even in part
+        class BrokenLog(io.BytesIO):
+            def read(self,size=-1):
+                if (self.tell()):
+                    raise OSError("connection reset")
+                return super().read(4)
+        build_info={'name':'TC/kvetch','number':1,'inProgress':False,
+                    'fullDisplayName':get_full_display_name("TC/kvetch",1),
+                    'description':None,'result':'FAILURE','duration':1,
+                    'timestamp':1,'url':'u','changeSets':[],'claims':[]}
+        job_info=dict.fromkeys(JOB_POINTERS,2)
+        job_info['name']='TC/kvetch'
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(OSError):
+                record_build(io.StringIO(),job_info,build_info,
+                             BrokenLog(b"line one\nline two\n"))
+            record_build(io.StringIO(),job_info,
+                         dict(build_info,number=2),io.BytesIO(b"ok\n"))
+        commit_sqlite()
+        self.assertFalse(db_build_num_exists('TC/kvetch',1))
+        self.assertEqual(0,cursor.execute(
+            'SELECT COUNT(*) FROM logchunks WHERE number = 1').fetchone()[0])
+        self.assertEqual("ok\n",db_get_build_log('TC/kvetch',2))
+        close_sqlite()
+
+    @unittest.skipIf(zstandard is None, "needs zstandard")
+    def test_log_dict(self):
+        global db_path, log_codec, LOG_DICT_SIZE
+        db_path=":memory:"
+        init_sqlite()
+        saved=(log_codec, LOG_DICT_SIZE)
+        LOG_DICT_SIZE=4096
+        def log(num):
+            return ''.join("[%d] step %d of build %d: compiling src/m%d.c\n"
+                           % (num*7+i, i, num, i*num % 13)
+                           for i in range(400))
+        try:
+            # Before zstd, then before and after the job has a dictionary
+            db_add_build_log("TC/kvetch",0,io.BytesIO(log(0).encode()))
+            log_codec='zstd'
+            for num in range(1,LOG_DICT_SAMPLES+3):
+                db_add_build_log("TC/kvetch",num,
+                                 io.BytesIO(log(num).encode()))
+            db_flush()
+            codecs_used=set(cursor.execute('''
+                SELECT IFNULL(c.codec,'zlib'), c.dictId IS NOT NULL
+                FROM logchunks l JOIN chunks c ON c.hash = l.hash
+            ''').fetchall())
+            self.assertEqual({('zlib',0),('zstd',0),('zstd',1)},codecs_used)
+
+            # Read back as a new run would
+            commit_sqlite()
+            log_dict_ids.clear()
+            zstd_compressors.clear()
+            zstd_decompressors.clear()
+            for num in range(0,LOG_DICT_SAMPLES+3):
+                self.assertEqual(log(num),db_get_build_log("TC/kvetch",num))
+        finally:
+            log_codec, LOG_DICT_SIZE = saved
+            log_dict_ids.clear()
+            log_dict_attempts.clear()
+            close_sqlite()
+
+    def test_db_iter_builds(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        for num in range(1,8):
+            db_add_build({'name':'TC/kvetch','number':num,
+                          'fullDisplayName':
+                              get_full_display_name("TC/kvetch",num),
+                          'description':None,
+                          'result':'SUCCESS' if num % 2 else 'FAILURE',
+                          'duration':1,'timestamp':num,'url':'u',
+                          'changeSets':[],'claims':[]})
+        def numbers(builds,where=None):
+            return [ b['number']
+                     for b in db_iter_builds("TC/kvetch",builds,where) ]
+        self.assertEqual([7,6,5,2],numbers([9,8,7,6,5,2]))
+        self.assertEqual([1,2,3],numbers([1,2,3]))
+        self.assertEqual([3,1,6],numbers([3,1,6]))
+        self.assertEqual([6,4],numbers([6,5,4],db_build_filters[skip_success]))
+        close_sqlite()
+
+    def test_log_search(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        if (not log_search_enabled):
+            self.skipTest("SQLite has no FTS5")
+        log=("ok\nmake: *** [all] Error 2\r\nfine\n"
+             "FAILED test_x, error: too many errors\nok")
+        indexer=new_log_search_indexer("TC/kvetch",1)
+        db_add_build_log("TC/kvetch",1,io.BytesIO(log.encode('utf-8')),
+                         [indexer])
+        indexer.finish()
+        # Stored without an indexer, so indexed when searched
+        db_add_build_log("TC/other",1,io.BytesIO(b"fine\nFatal error\n"))
+
+        def search(query,job_names=()):
+            return list(db_search_logs([ {'name':n} for n in job_names ],
+                                       query))
+        self.assertEqual([('TC/other',1,2,'Fatal error'),
+                          ('TC/kvetch',1,4,
+                           'FAILED test_x, error: too many errors'),
+                          ('TC/kvetch',1,2,'make: *** [all] Error 2')],
+                         search('error'))
+        self.assertEqual([('TC/other',1,2,'Fatal error')],
+                         search('error',['TC/other']))
+        self.assertEqual([],search('fine'))
+        self.assertEqual([],search('"error'))
+
+        # Every line with an empty pattern
+        pattern=log_search_pattern
+        init_log_search('')
+        try:
+            indexer=new_log_search_indexer("TC/kvetch",2)
+            db_add_build_log("TC/kvetch",2,io.BytesIO(b"a fine\n\nday\n"),
+                             [indexer])
+            indexer.finish()
+        finally:
+            init_log_search(pattern)
+        self.assertEqual([('TC/kvetch',2,1,'a fine')],search('fine'))
+        close_sqlite()
+
+    def test_mail_queue(self):
+        global mail_retry_delay
+        sessions=[]
+        class FakeSMTP:
+            # The first session is dropped, the next one busy once
+            replies=[smtplib.SMTPServerDisconnected("idle"),
+                     smtplib.SMTPDataError(451,"busy"),
+                     None,None,
+                     smtplib.SMTPDataError(554,"rejected")]
+            def __init__(self,host,port):
+                self.sent=[]
+                sessions.append(self)
+            def send_message(self,msg):
+                reply=FakeSMTP.replies.pop(0)
+                if (reply):
+                    raise reply
+                self.sent.append(msg['Subject'])
+            def quit(self):
+                pass
+        smtp, smtplib.SMTP = smtplib.SMTP, FakeSMTP
+        delay, mail_retry_delay = mail_retry_delay, 0
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out), \
+                 contextlib.redirect_stderr(err):
+                for subject in ("one","two","three"):
+                    send_email("a@x",None,subject,"body",'ON')
+                close_mail_pool()
+        finally:
+            smtplib.SMTP = smtp
+            mail_retry_delay = delay
+        self.assertEqual([[],[],["one","two"]],[s.sent for s in sessions])
+        self.assertEqual("",out.getvalue())
+        self.assertEqual(["✅ Email sent successfully."]*2 +
+                         ["❌ Failed to send email: (554, 'rejected')"],
+                         [ l for l in err.getvalue().splitlines()
+                           if l.startswith(("✅","❌")) ])
+        self.assertEqual([],FakeSMTP.replies)
+
+    def test_kvetch_digest(self):
+        global db_path, kvetch_digest, send_email
+        db_path=":memory:"
+        init_sqlite()
+        def kvetch_info(name,num,target):
+            return {'jobName':name,'build':num,'target':target,
+                    'timestamp':0,'level':1}
+        sent=[]
+        send, send_email = send_email, lambda *args: sent.append(args)
+        kvetch_digest=True
+        try:
+            kvetch_email("dev@x","mon@x","Kvetch: a #1","a\n",
+                         kvetch_info("TC/a",1,"dev@x"))
+            kvetch_email("lead@x",None,"Kvetch: c #3","c\n",
+                         kvetch_info("TC/c",3,"lead@x"))
+            kvetch_email("dev@x","mon@x","Kvetch: b #2","b\n",
+                         kvetch_info("TC/b",2,"dev@x"))
+            # Pending until the digests are sent
+            self.assertEqual([],sent)
+            self.assertEqual(2,get_kvetch_info("TC/b")['build'])
+            self.assertIsNone(db_get_kvetch_info("TC/b"))
+            send_kvetch_digests()
+        finally:
+            send_email=send
+            kvetch_digest=False
+        self.assertEqual([("dev@x","mon@x","Kvetch: 2 builds"),
+                          ("lead@x",None,"Kvetch: c #3")],
+                         [ args[:3] for args in sent ])
+        self.assertIn("Kvetch: b #2\n============\n\nb\n",sent[0][3])
+        self.assertEqual(2,db_get_kvetch_info("TC/b")['build'])
+        self.assertEqual({},kvetch_pending)
+        close_sqlite()
+
+    def test_http_api(self):
+        global db_path, scan_log_key, scan_log_fingerprint
+        import urllib.request, urllib.error
+        def add_build(name,num,result,claims=[]):
+            db_add_build({'name':name,'number':num,
+                          'fullDisplayName':get_full_display_name(name,num),
+                          'description':None,'result':result,'duration':1,
+                          'timestamp':num,'url':'u','changeSets':[],
+                          'claims':claims})
+        scanner = (scan_log_key, scan_log_fingerprint)
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path=os.path.join(tmp,"kvetch-db")
+            init_sqlite()
+            scan_log_key, scan_log_fingerprint = 'scanlog.py:ScanLog', 'v1'
+            api_server=make_api_server(0)
+            threading.Thread(target=api_server.serve_forever,
+                             daemon=True).start()
+            def get(path):
+                url="http://%s:%d%s" % (api_server.server_address+(path,))
+                try:
+                    with urllib.request.urlopen(url) as response:
+                        return (response.status,json.load(response))
+                except urllib.error.HTTPError as e:
+                    return (e.code,json.load(e))
+            try:
+                add_build("TC/a",1,'SUCCESS')
+                add_build("TC/a",2,'FAILURE',[{'claimedBy':'cdickens'}])
+                add_build("TC/b",1,'SUCCESS')
+                db_set_view_jobs("V",["TC/a","TC/b"])
+                db_set_scan_result("TC/a",2,'scanlog.py:ScanLog','v1',
+                                   {'summary':'x'})
+                commit_sqlite()
+
+                status, jobs = get("/status?view=V")
+                self.assertEqual([('TC/a',1,2),('TC/b',1,1)],
+                                 [ (j['name'],j['lastSuccessfulBuild'],
+                                    j['lastBuild']['number']) for j in jobs ])
+                self.assertEqual([2,1],[ b['number'] for b in
+                                         get("/history?job=TC/a")[1] ])
+                self.assertEqual([1],[ b['number'] for b in
+                                       get("/history?job=TC/a&before=2")[1] ])
+                self.assertEqual((200,{'summary':'x'}),
+                                 get("/scan?job=TC/a&build=2"))
+                self.assertEqual([('TC/a',2,'cdickens')],
+                                 [ (c['name'],c['number'],
+                                    c['claims'][0]['claimedBy'])
+                                   for c in get("/claims")[1] ])
+                self.assertEqual({'V':['TC/a','TC/b']},get("/views")[1])
+                self.assertEqual(404,get("/scan?job=TC/b&build=1")[0])
+                self.assertEqual(404,get("/status?view=W")[0])
+                self.assertEqual(400,get("/history?job=TC/a&limit=x")[0])
+
+                # Cached until cleared
+                get("/status?job=TC/b")
+                add_build("TC/b",2,'FAILURE')
+                commit_sqlite()
+                self.assertEqual(1,get("/status?job=TC/b")[1][0]
+                                 ['lastBuild']['number'])
+                clear_api_cache()
+                self.assertEqual(2,get("/status?job=TC/b")[1][0]
+                                 ['lastBuild']['number'])
+            finally:
+                api_server.shutdown()
+                api_server.server_close()
+                while (not api_conns.empty()):
+                    api_conns.get().close()
+                clear_api_cache()
+                scan_log_key, scan_log_fingerprint = scanner
+                close_sqlite()
+
+    def test_http_cache(self):
+        global db_path, server
+        requested=[]
+        class FakeResponse:
+            def __init__(self,status_code,content,headers):
+                self.status_code=status_code
+                self.content=content
+                self.headers=headers
+        class FakeJenkins:
+            server='https://jenkins/'
+            body=b'{"inProgress": true}'
+            def jenkins_request(self,req):
+                requested.append(req.headers)
+                if (req.headers.get('If-None-Match') == '"1"'):
+                    return FakeResponse(304,b'',{})
+                return FakeResponse(200,self.body,{'ETag':'"1"'})
+        saved=(db_path, server)
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path=os.path.join(tmp,"kvetch-db")
+            server=FakeJenkins()
+            init_http_cache()
+            try:
+                # A running build is revalidated every time
+                for _ in range(2):
+                    self.assertTrue(jenkins_get_json('job/a/1/','x','build')
+                                    ['inProgress'])
+                self.assertEqual([{},{'If-None-Match':'"1"'}],requested)
+
+                # Once finished, it is served from the cache
+                server.body=b'{"inProgress": false}'
+                http_cache_conn.execute('DELETE FROM responses')
+                for _ in range(2):
+                    jenkins_get_json('job/a/1/','x','build')
+                self.assertEqual(3,len(requested))
+
+                # Also by the next run
+                close_http_cache()
+                init_http_cache()
+                self.assertFalse(jenkins_get_json('job/a/1/','x','build')
+                                 ['inProgress'])
+                self.assertEqual(3,len(requested))
+
+                jenkins_get_json('job/a/1/','x')
+                self.assertEqual(4,len(requested))
+            finally:
+                close_http_cache()
+                db_path, server = saved
+
+    def test_http_cache_claims(self):
+        global db_path, server
+        fake=FakeJenkins({1:{'result':'FAILURE'}})
+        saved=(db_path, server)
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path=os.path.join(tmp,"kvetch-db")
+            server=fake
+            init_http_cache()
+            try:
+                self.assertEqual([],get_build_info('TC/a',1)['claims'])
+                fake.builds[1]['actions']=[
+                    {'_class':'hudson.plugins.claim.ClaimBuildAction',
+                     'claimedBy':'bob','assignedBy':'amy','claimDate':1,
+                     'reason':'mine'}]
+                self.assertEqual([],get_build_info('TC/a',1)['claims'])
+                self.assertEqual(1,len(fake.requested))
+
+                # Claimed after the build finished, seen once the TTL passed
+                http_cache_conn.execute('''
+                    UPDATE responses
+                    SET expires = expires - ?
+                ''', (http_cache_ttls['build'],))
+                self.assertEqual('bob',get_claimedBy(
+                    get_build_info('TC/a',1)))
+                self.assertEqual(2,len(fake.requested))
+            finally:
+                close_http_cache()
+                db_path, server = saved
+
+    def test_jenkins_retries(self):
+        global jenkins_retry_delay, jenkins_breaker_failures
+        global jenkins_breaker_seconds
+        def reply(status):
+            response=requests.Response()
+            response.status_code=status
+            response.headers['Retry-After']='0'
+            response.raw=io.BytesIO()
+            return response
+        replies=[reply(503),requests.ConnectionError("reset"),reply(200),
+                 reply(502),reply(502),reply(404)]
+        def send(request,**kwargs):
+            r=replies.pop(0)
+            if (isinstance(r,Exception)):
+                raise r
+            return r
+        saved=(jenkins_retry_delay, jenkins_breaker_failures,
+               jenkins_breaker_seconds)
+        (jenkins_retry_delay, jenkins_breaker_failures,
+         jenkins_breaker_seconds) = (0, 2, 0.1)
+        try:
+            client=KvetchJenkins('https://jenkins/')
+            client._session.send=send
+            get=requests.Request('GET','https://jenkins/api/json')
+            self.assertEqual(200,client._request(get).status_code)
+            self.assertLess(client._rate,jenkins_rate)
+
+            # Two failures in a row open the circuit
+            start=time.monotonic()
+            self.assertEqual(404,client._request(get).status_code)
+            self.assertGreater(client._open_until,start)
+            self.assertEqual(0,client._failures)
+            self.assertEqual([],replies)
+        finally:
+            (jenkins_retry_delay, jenkins_breaker_failures,
+             jenkins_breaker_seconds) = saved
+
+    @unittest.skipIf(aiohttp is None, "needs aiohttp")
+    def test_async_backend(self):
+        global server, fetch_pool, jenkins_retries, jenkins_retry_delay
+        global jenkins_breaker_failures
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if (self.path.startswith('/job/TC/job/missing/')):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if (self.path.startswith('/job/TC/job/slow/')):
+                    time.sleep(1)
+                if (self.path.startswith('/job/TC/job/cut/')):
+                    # The body is cut short after the headers
+                    self.send_response(200)
+                    self.send_header('Content-Length','100')
+                    self.end_headers()
+                    self.wfile.write(b'{"na')
+                    self.close_connection=True
+                    return
+                body=json.dumps({'name':self.path.split('/')[4]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self,*args):
+                pass
+        http_server=ThreadingHTTPServer(('127.0.0.1',0),Handler)
+        threading.Thread(target=http_server.serve_forever,daemon=True).start()
+        saved=(server, fetch_pool, jenkins_retries, jenkins_retry_delay,
+               jenkins_breaker_failures)
+        server=KvetchJenkins('http://127.0.0.1:%d/' %
+                             http_server.server_address[1],
+                             username='u',password='p')
+        fetch_pool=None
+        jenkins_retries=1
+        jenkins_retry_delay=0.01
+        jenkins_breaker_failures=10
+        start_jenkins_loop()
+        loop=jenkins_loop
+        try:
+            names=["TC/j%d" % i for i in range(50)]
+            self.assertEqual([n.split('/')[1] for n in names],
+                             [ j['name'] for j in
+                               fetch_ordered(get_job_status,names) ])
+            self.assertIsInstance(fetch_pool,AsyncFetchPool)
+            with self.assertRaises(jenkins.NotFoundException):
+                get_job_status("TC/missing")
+            # Both tries failed reading the body, neither is a success
+            with self.assertRaises(jenkins.JenkinsException):
+                get_job_status("TC/cut")
+            self.assertEqual(2,server._failures)
+            future=get_fetch_pool().submit(get_job_status,"TC/slow")
+            close_fetch_pool()
+            self.assertTrue(future.cancelled())
+        finally:
+            close_jenkins_loop()
+            http_server.shutdown()
+            http_server.server_close()
+            (server, fetch_pool, jenkins_retries, jenkins_retry_delay,
+             jenkins_breaker_failures) = saved
+        self.assertTrue(loop.is_closed())
+
+    def test_failure_signatures(self):
+        global db_path
+        db_path=":memory:"
+        init_sqlite()
+        self.assertEqual("[<time>] <path>:<n>: error: x at <hex>\nmake: ***",
+                         normalize_failure("[2025-06-01T10:12:13.5Z] "
+                                           "/ws/b12/a.c:42:  error: x at "
+                                           "0x7ffd\n\n  make: ***  "))
+        def build(name,num,result,s):
+            return ({'name':name,'number':num,'result':result,
+                     'timestamp':num*1000},
+                    {'summary':s})
+        failures=[ build("TC/a",1,'FAILURE',"/ws/a/x.c:10: error: y\n"),
+                   build("TC/a",2,'FAILURE',"/ws/a/x.c:12: error: y\n"),
+                   build("TC/b",7,'UNSTABLE',"/ws/b/x.c:12: error: y\n"),
+                   build("TC/b",8,'FAILURE',"/ws/b/x.c:12: error: z\n"),
+                   build("TC/b",9,'SUCCESS',"/ws/b/x.c:12: error: y\n") ]
+        for build_info, s in failures + failures[:1]:
+            db_add_failure(build_info,s)
+        signature=failure_signature(*failures[0])[0]
+        self.assertEqual([signature],db_get_build_failures("TC/b",7))
+        self.assertEqual([],db_get_build_failures("TC/b",9))
+        failure=db_get_failure(signature)
+        self.assertEqual((1000,7000,3,['TC/a','TC/b']),
+                         (failure['firstSeen'],failure['lastSeen'],
+                          failure['count'],failure['jobs']))
+        self.assertEqual(1,db_get_failure(
+            failure_signature(*failures[3])[0])['count'])
+        # A scan log plugin can give the text that identifies the failure
+        self.assertEqual((None,None),failure_signature(
+            failures[0][0],{'summary':'Nothing found','signature':''}))
+        close_sqlite()
+
+    def test_scan_pool(self):
+        global db_path, scan_workers, scan_log_scanner, scan_log_path
+        global scan_log_func_name, scan_log_key, scan_log_fingerprint
+        saved=(db_path, scan_workers, scan_log_scanner, scan_log_path,
+               scan_log_func_name, scan_log_key, scan_log_fingerprint)
+        with tempfile.TemporaryDirectory() as tmp:
+            plugin=os.path.join(tmp,"upper.py")
+            with open(plugin,'w') as f:
+                f.write("def ScanLog(f):\n"
+                        "    text=f.read()\n"
+                        "    if ('explode' in text):\n"
+                        "        raise ValueError('cannot scan')\n"
+                        "    return {'summary':text.upper()}\n")
+            db_path=os.path.join(tmp,"kvetch-db")
+            scan_workers=2
+            init_sqlite()
+            init_scan_log(plugin,'ScanLog')
+            try:
+                for num, log in enumerate(["one\n","two\n","explode\n"],1):
+                    db_add_build({'name':'TC/a','number':num,
+                                  'fullDisplayName':
+                                      get_full_display_name('TC/a',num),
+                                  'description':None,'result':'FAILURE',
+                                  'duration':1,'timestamp':num,'url':'u',
+                                  'changeSets':[],'claims':[]})
+                    db_add_build_log('TC/a',num,io.BytesIO(log.encode()))
+                job_info={'name':'TC/a','builds':[1,2]}
+                scans=[ (build_info['number'],s['summary']) for
+                        (j, build_info), s in db_scan_builds(
+                            db_select_builds([job_info],None),scan_all) ]
+                self.assertEqual([(1,"ONE\n"),(2,"TWO\n")],scans)
+                self.assertIsNotNone(scan_pool)
+
+                # Logs still stored as a single blob, as in a DB upgraded
+                # from ver 1, are converted before the workers read them
+                for num in (4,5,6):
+                    db_add_build({'name':'TC/a','number':num,
+                                  'fullDisplayName':
+                                      get_full_display_name('TC/a',num),
+                                  'description':None,'result':'FAILURE',
+                                  'duration':1,'timestamp':num,'url':'u',
+                                  'changeSets':[],'claims':[]})
+                    cursor.execute('INSERT INTO logfiles VALUES (?,?,?)',
+                                   (db_job_id('TC/a'),num,
+                                    zlib.compress(b"old %d\n" % num)))
+                commit_sqlite()
+                job_info['builds']=[4,5,6]
+                scans=[ (build_info['number'],s['summary']) for
+                        (j, build_info), s in db_scan_builds(
+                            db_select_builds([job_info],None),scan_all) ]
+                self.assertEqual([(4,"OLD 4\n"),(5,"OLD 5\n"),(6,"OLD 6\n")],
+                                 scans)
+
+                # A scan that fails in a worker fails the caller
+                job_info['builds']=[3]
+                with self.assertRaises(ValueError):
+                    list(db_scan_builds(db_select_builds([job_info],None),
+                                        scan_all))
+            finally:
+                close_scan_pool()
+                close_sqlite()
+                (db_path, scan_workers, scan_log_scanner, scan_log_path,
+                 scan_log_func_name, scan_log_key,
+                 scan_log_fingerprint) = saved
+
+    def test_scan_results_cache(self):
+        global db_path, scan_log_scanner
+        db_path=":memory:"
+        init_sqlite()
+        db_add_build({'name':'TC/kvetch','number':1,
+                      'fullDisplayName':get_full_display_name("TC/kvetch",1),
+                      'description':None,'result':'FAILURE','duration':1,
+                      'timestamp':1,'url':'u','changeSets':[],'claims':[]})
+        db_add_build_log("TC/kvetch",1,io.BytesIO(b"one\ntwo\n"))
+        job_infos=[{'name':'TC/kvetch','builds':[1]}]
+        def scans():
+            found=[]
+            db_for_each_build(job_infos,None,
+                              lambda f,j,b,s: found.append(s['summary']),
+                              None,scan_all)
+            return found
+        def load(plugin,version):
+            with open(plugin,'w') as f:
+                f.write("def scan(f):\n"
+                        f"    return {{'summary': '{version}'}}\n")
+            init_scan_log(plugin,"scan")
+            db_check_scanner(scan_log_key,scan_log_fingerprint)
+        with tempfile.TemporaryDirectory() as tmp:
+            plugin=os.path.join(tmp,"scan.py")
+            for version in ("v1","v2"):
+                load(plugin,version)
+                self.assertEqual([version],scans())
+                # Served from scan_results from now on
+                scan_log_scanner=None
+                self.assertEqual([version],scans())
+
+            # Another plugin with a function of the same name
+            os.mkdir(os.path.join(tmp,"other"))
+            load(os.path.join(tmp,"other","scan.py"),"other")
+            self.assertEqual(["other"],scans())
+            init_scan_log(plugin,"scan")
+            db_check_scanner(scan_log_key,scan_log_fingerprint)
+            scan_log_scanner=None
+            self.assertEqual(["v2"],scans())
+        close_sqlite()
+
+    def test_migrate_v1(self):
+        global db_path
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path=os.path.join(tmp,"kvetch.db")
+            v1=sqlite3.connect(db_path)
+            v1.executescript('''
+                CREATE TABLE schema (version INTEGER);
+                INSERT INTO schema VALUES (1);
+                CREATE TABLE logfiles (fullDisplayName TEXT PRIMARY KEY,
+                                       contents BLOB);
+                CREATE TABLE kvetch (jobName TEXT PRIMARY KEY, target TEXT,
+                                     build INTEGER, timestamp INTEGER,
+                                     level INTEGER);
+                CREATE TABLE builds (fullDisplayName TEXT PRIMARY KEY,
+                                     description TEXT, result TEXT not NULL,
+                                     duration INTEGER, timestamp INTEGER,
+                                     url TEXT not NULL, changeSets TEXT,
+                                     claims TEXT);
+                INSERT INTO builds VALUES ('TC » kvetch #12', NULL,
+                    'FAILURE', 5, 1000, 'https://jenkins/12', '[]', '[]');
+                INSERT INTO kvetch VALUES ('TC/kvetch', 'bob', 12, 1000, 1);
+            ''')
+            v1.execute('INSERT INTO logfiles VALUES (?,?)',
+                       ('TC » kvetch #12',zlib.compress(b"failed\n")))
+            v1.commit()
+            v1.close()
+
+            init_sqlite()
+            self.assertEqual(2,cursor.execute(
+                'SELECT version FROM schema').fetchone()[0])
+            build_info=db_get_build_info("TC/kvetch",12)
+            self.assertEqual('FAILURE',build_info['result'])
+            self.assertEqual('TC » kvetch #12',build_info['fullDisplayName'])
+            self.assertEqual('bob',db_get_kvetch_info("TC/kvetch")['target'])
+            self.assertEqual("failed\n",db_get_build_log("TC/kvetch",12))
+            close_sqlite()